@@ -1,17 +1,33 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, Response
+import time
+_STARTUP_STARTED = time.perf_counter()   # 啟動計時起點（在其他 import 之前）
+
+from flask import (Flask, render_template, request, redirect, url_for, flash, session, g, send_file,
+                   Response, stream_with_context, abort, jsonify, make_response, get_template_attribute)
 from datetime import datetime
 from dotenv import load_dotenv
 import os
 import logging
 import json
+import csv
+import io
+import zlib
+import re
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+import threading
+from cachetools import TTLCache, LRUCache
 from werkzeug.security import check_password_hash, generate_password_hash
 from werkzeug.utils import secure_filename
+from markupsafe import Markup, escape
 import tempfile
-from openpyxl import Workbook
-from openpyxl.styles import Font, PatternFill, Alignment
-from io import BytesIO
-from db_supabase import get_db_connection_wrapper
-from tt import upload_file_to_supabase
+from itertools import chain, islice
+from db_supabase import (get_db_connection_wrapper, get_cache_version, bump_cache_version,
+                         SYSTEMS, SYSTEM_ID_FOR_NAME_SQL)
+from tt import (upload_files_to_supabase, build_storage_filename, create_signed_upload_url,
+                storage_object_info, get_public_url, schedule_thumbnail, thumbnail_key,
+                upload_file_to_supabase, storage_available, StorageUnavailable,
+                CONTENT_CACHE_CONTROL, STORAGE_BREAKER_RESET)
+from bug_import import import_bugs, ImportFileError, STATUSES, PRIORITIES
 
 load_dotenv()
 
@@ -25,6 +41,11 @@ app.secret_key = os.getenv('SECRET_KEY')
 if not app.secret_key:
     raise ValueError("請在 .env 檔案中設定 SECRET_KEY！")
 
+# 使用者/權限快取設定（秒）
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', '60'))
+USER_CACHE_MAXSIZE = int(os.getenv('USER_CACHE_MAXSIZE', '1024'))
+CACHE_VERSION_CHECK_INTERVAL = float(os.getenv('CACHE_VERSION_CHECK_INTERVAL', '5'))
+
 # Error handler for better debugging
 @app.errorhandler(500)
 def internal_error(error):
@@ -41,16 +62,158 @@ def format_datetime(value):
         return value.strftime('%Y-%m-%d %H:%M:%S')
     return value
 
+# 將秒數格式化為「N 天 N 小時」等易讀長度
+@app.template_filter('format_duration')
+def format_duration(seconds):
+    """Format a number of seconds as days/hours/minutes"""
+    if seconds is None:
+        return '—'
+    minutes = int(seconds) // 60
+    days, minutes = divmod(minutes, 24 * 60)
+    hours, minutes = divmod(minutes, 60)
+    if days:
+        return f'{days} 天 {hours} 小時'
+    if hours:
+        return f'{hours} 小時 {minutes} 分'
+    return f'{minutes} 分'
+
+# 搜尋結果摘要：擷取關鍵字前後文字並以 <mark> 標示
+@app.template_filter('search_snippet')
+def search_snippet(value, query, radius=60):
+    """Return an HTML-escaped excerpt of value around query with matches highlighted"""
+    if not value:
+        return value
+    text = str(value)
+    if not query:
+        return text
+    pattern = re.compile(re.escape(query), re.IGNORECASE)
+    first = pattern.search(text)
+    if first is None:
+        return text if len(text) <= radius * 2 else text[:radius * 2] + '…'
+    start = max(first.start() - radius, 0)
+    end = min(first.end() + radius, len(text))
+    excerpt = text[start:end]
+    # pattern.split drops the matched text, so re-insert it with its original casing
+    parts = pattern.split(excerpt)
+    matches = pattern.findall(excerpt)
+    highlighted = Markup('')
+    for i, part in enumerate(parts):
+        highlighted += escape(part)
+        if i < len(matches):
+            highlighted += Markup('<mark>{}</mark>').format(matches[i])
+    prefix = '…' if start > 0 else ''
+    suffix = '…' if end < len(text) else ''
+    return Markup(prefix) + highlighted + Markup(suffix)
+
+# 每個請求共用一個資料庫連線（從連線池取出一次，請求結束時 commit / rollback 並歸還）
 def get_db_connection():
-    return get_db_connection_wrapper()
+    """Return the request-scoped connection, checking one out of the pool on first use"""
+    if 'db' not in g:
+        g.db = get_db_connection_wrapper()
+    return g.db
+
+@app.teardown_appcontext
+def close_db_connection(exception):
+    """Commit (or roll back on error) the request-scoped connection and return it to the pool"""
+    conn = g.pop('db', None)
+    if conn is None:
+        return
+    try:
+        if exception is None:
+            conn.commit()
+            _apply_user_cache_version(g.pop('users_version', None))
+        else:
+            conn.rollback()
+    except Exception as e:
+        logger.error(f'Error finishing request transaction: {e}', exc_info=True)
+    finally:
+        conn.close()
+
+def release_db_connection():
+    """Commit the request-scoped connection and return it to the pool before slow non-DB work.
+
+    The next get_db_connection() in the request checks out a fresh one.
+    """
+    conn = g.pop('db', None)
+    if conn is None:
+        return
+    try:
+        conn.commit()
+    finally:
+        conn.close()
+    _apply_user_cache_version(g.pop('users_version', None))
+
+# 使用者記錄快取（TTL + LRU），以 user_id 為 key，值為 (讀取時的 'users' 版本, 記錄)。
+# 其他 worker 的修改透過 cache_versions 表的 'users' 版本號同步：
+# 每 CACHE_VERSION_CHECK_INTERVAL 秒最多查一次版本，版本變更即清空本地快取；
+# 版本不符的項目一律視為未快取，避免並行請求在 commit 前讀到的舊記錄被留下。
+_user_cache = TTLCache(maxsize=USER_CACHE_MAXSIZE, ttl=USER_CACHE_TTL)
+_user_cache_lock = threading.Lock()
+_user_cache_state = {'version': None, 'checked_at': 0.0}
+
+def _user_cache_version_due():
+    """True (once per CACHE_VERSION_CHECK_INTERVAL) when the 'users' version should be re-read"""
+    now = time.monotonic()
+    with _user_cache_lock:
+        if now - _user_cache_state['checked_at'] < CACHE_VERSION_CHECK_INTERVAL:
+            return False
+        _user_cache_state['checked_at'] = now
+        return True
+
+def _apply_user_cache_version(version):
+    """Move the local cache to a newer 'users' version (versions only grow), dropping older entries"""
+    if version is None:
+        return
+    with _user_cache_lock:
+        current = _user_cache_state['version']
+        if current is None or version > current:
+            _user_cache.clear()
+            _user_cache_state['version'] = version
+
+def invalidate_user_cache():
+    """Mark every cached user record stale after a permission/password change.
+
+    Invalidation is global: the single 'users' version is bumped, so every
+    worker drops its whole user cache, not just the changed users (these
+    changes are rare admin actions, and a miss costs one primary-key lookup).
+    Call before committing the change: the version bump is part of the same
+    transaction. Other workers pick it up on their next version check; this
+    worker switches to the new version once the request's transaction has
+    committed (close_db_connection), so a concurrent request cannot re-cache
+    the pre-change row under the new version.
+    """
+    g.users_version = bump_cache_version(get_db_connection(), 'users')
+
+def bump_data_version():
+    """Mark bug data as changed (in the current transaction) so cached exports are rebuilt"""
+    return bump_cache_version(get_db_connection(), 'bugs')
+
+CURRENT_USER_SQL = '''
+    SELECT u.*, ARRAY(SELECT us.system_id FROM user_systems us WHERE us.user_id = u.id ORDER BY us.system_id) AS system_ids
+    FROM users u WHERE u.id = %s
+'''
 
 # 取得目前登入使用者
 def get_current_user():
+    """The logged-in user's record (cached), or None"""
     if 'user_id' not in session:
         return None
-    conn = get_db_connection()
-    user = conn.execute('SELECT * FROM users WHERE id = %s', (session['user_id'],)).fetchone()
-    conn.close()
+    if 'current_user' in g:
+        return g.current_user
+
+    user_id = session['user_id']
+    if _user_cache_version_due():
+        _apply_user_cache_version(get_cache_version(get_db_connection(), 'users'))
+    with _user_cache_lock:
+        version = _user_cache_state['version']
+        cached = _user_cache.get(user_id)
+    user = cached[1] if cached and cached[0] == version else None
+    if user is None:
+        user = get_db_connection().execute(CURRENT_USER_SQL, (user_id,)).fetchone()
+        if user is not None:
+            with _user_cache_lock:
+                _user_cache[user_id] = (version, user)
+    g.current_user = user
     return user
 
 # 判斷是否為管理員
@@ -78,83 +241,637 @@ def can_edit_or_delete(bug, user):
         return True
     return bug['reported_by_user_id'] == user['id']
 
-# 首頁 - 錯誤記錄列表（登入後才顯示記錄）
-@app.route('/', methods=['GET'])
-def index():
-    user = get_current_user()
-    
-    if user:
-        query = request.args.get('query', '')
-        conn = get_db_connection()
+# 依使用者權限產生 bugs b 的可見範圍條件（列表與匯出共用）
+def build_bug_permission_filter(user):
+    """Return (clause_sql, params) restricting bugs aliased as b to what user may see.
 
-        # Build permission filters based on user rights
-        allowed_systems = []
-        # Map module flags to system name fragments (case-insensitive)
-        if user.get('m18'):
-            allowed_systems.append('m18')
-        if user.get('eshop'):
-            allowed_systems.append('eshop')
-        if user.get('jetplus'):
-            allowed_systems.append('jetplus')
-        if user.get('sugarcrm'):
-            allowed_systems.append('sugarcrm')
-        if user.get('shopline'):
-            allowed_systems.append('shopline')
-
-        def build_permission_clause(user_id, systems):
-            # Returns (clause_sql, params)
-            if systems:
-                # We'll use ILIKE pattern matching for flexible matching
-                system_clauses = ' OR '.join(['b.system ILIKE %s' for _ in systems])
-                clause = f"(b.reported_by_user_id = %s OR ({system_clauses}))"
-                params = [user_id] + [f'%{s}%' for s in systems]
-            else:
-                clause = "(b.reported_by_user_id = %s)"
-                params = [user_id]
-            return clause, params
-
-        if query:
-            search_clause = '(b.bug_details ILIKE %s OR b.system ILIKE %s OR b.notes ILIKE %s)'
-            search_params = [f'%{query}%', f'%{query}%', f'%{query}%']
-            if is_admin(user):
-                sql = f"SELECT b.*, u.username as reporter_username FROM bugs b LEFT JOIN users u ON b.reported_by_user_id = u.id WHERE {search_clause} ORDER BY b.report_date DESC"
-                bugs = conn.execute(sql, tuple(search_params)).fetchall()
-            else:
-                perm_clause, perm_params = build_permission_clause(user['id'], allowed_systems)
-                sql = f"SELECT b.*, u.username as reporter_username FROM bugs b LEFT JOIN users u ON b.reported_by_user_id = u.id WHERE {search_clause} AND {perm_clause} ORDER BY b.report_date DESC"
-                bugs = conn.execute(sql, tuple(search_params + perm_params)).fetchall()
+    Admins get an empty clause. Other users see their own reports plus bugs
+    whose system_id is mapped to them in user_systems.
+    """
+    if is_admin(user):
+        return '', []
+    system_ids = list(user.get('system_ids') or [])
+    if system_ids:
+        return '(b.reported_by_user_id = %s OR b.system_id = ANY(%s))', [user['id'], system_ids]
+    return '(b.reported_by_user_id = %s)', [user['id']]
+
+# 列表分頁設定
+BUG_LIST_PAGE_SIZE = int(os.getenv('BUG_LIST_PAGE_SIZE', '50'))
+BUG_LIST_MAX_PAGE_SIZE = int(os.getenv('BUG_LIST_MAX_PAGE_SIZE', '200'))
+
+# 列表頁只取畫面需要的欄位（不含 file_path 等大欄位）
+BUG_LIST_COLUMNS = '''b.id, b.report_date, b.system, b.bug_details, b.reported_by, b.status, b.priority,
+       b.severity, b.assigned_to, b.resolution_date, b.notes, b.reported_by_user_id,
+       u.username as reporter_username'''
+
+# 單筆檢視 / 編輯用的欄位（不含產生欄位 search_text / search_vector）
+BUG_DETAIL_COLUMNS = '''id, report_date, system, bug_details, reported_by, status, priority, severity,
+       assigned_to, resolution_date, notes, reported_by_user_id, system_id, updated_at'''
+
+def encode_page_cursor(bug):
+    """Encode a (sort_key, id) keyset cursor for use in a URL; None if the row has no sort key"""
+    key = bug['sort_key']
+    if key is None:
+        return None
+    key = key.isoformat() if isinstance(key, datetime) else repr(float(key))
+    return f"{key}|{bug['id']}"
+
+def decode_page_cursor(value, sort):
+    """Decode a cursor produced by encode_page_cursor; returns None if invalid"""
+    if not value:
+        return None
+    try:
+        key, bug_id = value.rsplit('|', 1)
+        key = datetime.fromisoformat(key) if sort == 'date' else float(key)
+        return key, int(bug_id)
+    except ValueError:
+        return None
+
+# CJK 字元區段（與 migration 4 建立的 SQL 函式 bug_search_tokens 相同），中文以雙字詞 (bigram) 比對
+CJK_RUN = re.compile('[\u3400-\u9fff\uf900-\ufaff]+')
+
+def build_search_tsquery(query):
+    """Build a to_tsquery('simple', ...) string matching the bug_search_tokens() SQL function (migrations.py).
+
+    CJK runs become overlapping bigrams, other words are lower-cased; terms are
+    OR-ed together because the tsquery is only used for ranking.
+    """
+    terms = []
+    for chunk in query.split():
+        pos = 0
+        for m in CJK_RUN.finditer(chunk):
+            terms += re.findall(r'\w+', chunk[pos:m.start()])
+            run = m.group()
+            terms += [run] if len(run) == 1 else [run[i:i + 2] for i in range(len(run) - 1)]
+            pos = m.end()
+        terms += re.findall(r'\w+', chunk[pos:])
+    quoted = []
+    for term in dict.fromkeys(t.lower() for t in terms):
+        quoted.append("'" + term.replace('\\', '\\\\').replace("'", "''") + "'")
+    return ' | '.join(quoted)
+
+def build_search_filter_tsquery(query):
+    """Build a to_tsquery('simple', ...) string that every ILIKE '%query%' match satisfies ('' if none).
+
+    Each bigram of a CJK run of two or more characters is also a bigram of the
+    matching document run (see the bug_search_tokens() SQL function in
+    migrations.py), so they are AND-ed and the search_vector GIN index can
+    narrow the rows before the ILIKE recheck.
+    Latin words may be parts of longer tokens and a lone CJK character may be
+    the second half of a bigram, so those are left to ILIKE alone.
+    """
+    bigrams = []
+    for run in CJK_RUN.findall(query):
+        bigrams += [run[i:i + 2] for i in range(len(run) - 1)]
+    return ' & '.join(f"'{bigram}'" for bigram in dict.fromkeys(bigrams))
+
+def escape_like(value):
+    """Escape LIKE wildcards so user input is matched literally"""
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def get_page_size():
+    try:
+        page_size = int(request.args.get('per_page', BUG_LIST_PAGE_SIZE))
+    except ValueError:
+        page_size = BUG_LIST_PAGE_SIZE
+    return max(1, min(page_size, BUG_LIST_MAX_PAGE_SIZE))
+
+# 條件式 GET：ETag 由模板版本、使用者 / 權限範圍、資料版本與查詢參數組成，
+# 使用者重新整理而資料未變時直接回 304，不再查詢列表也不渲染模板
+TEMPLATE_STAMP = max((entry.stat().st_mtime_ns for entry in os.scandir(os.path.join(app.root_path, app.template_folder))),
+                     default=0)
+
+def page_etag(*parts):
+    """Weak ETag for a rendered page; None when it must be rendered anyway (pending flash messages)"""
+    if session.get('_flashes'):
+        return None
+    return hashlib.sha1('|'.join(str(part) for part in (TEMPLATE_STAMP, *parts)).encode('utf-8')).hexdigest()
+
+def not_modified(etag):
+    """Return a 304 response if the client's If-None-Match already has etag, else None"""
+    if etag and request.if_none_match.contains_weak(etag):
+        return with_etag(Response(status=304), etag)
+    return None
+
+def with_etag(response, etag):
+    """Attach etag and require revalidation on every use (pages are per-user, so private)"""
+    response = make_response(response)
+    if etag:
+        response.set_etag(etag, weak=True)
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+# 列表片段快取：同一可見範圍 + 搜尋條件 + 分頁的資料列與渲染好的 HTML 共用，
+# 只在輸出時依使用者決定每列用「可編輯」或「唯讀」版本。
+# key 含 bugs 資料版本，任何寫入後舊項目不再命中（版本變更時整個清空以釋放記憶體）
+BUG_LIST_CACHE_SIZE = int(os.getenv('BUG_LIST_CACHE_SIZE', '128'))
+_bug_list_cache = LRUCache(maxsize=BUG_LIST_CACHE_SIZE)
+_bug_list_cache_lock = threading.Lock()
+_bug_list_cache_state = {'version': None}
+
+def _bug_list_cache_get(key, version):
+    with _bug_list_cache_lock:
+        if _bug_list_cache_state['version'] != version:
+            _bug_list_cache.clear()
+            _bug_list_cache_state['version'] = version
+        return _bug_list_cache.get(key)
+
+def _bug_list_cache_put(key, version, value):
+    with _bug_list_cache_lock:
+        if _bug_list_cache_state['version'] == version:
+            _bug_list_cache[key] = value
+
+def bug_list_scope_key(user, version):
+    """Cache scope for user's visible bugs.
+
+    Non-admins see their own reports plus their systems' bugs; when none of
+    their own reports fall outside those systems the visible set is just the
+    systems' bugs, so users with the same systems share one scope.
+    """
+    if is_admin(user):
+        return 'admin'
+    system_ids = sorted(user.get('system_ids') or [])
+    systems = ','.join(str(i) for i in system_ids)
+    if not system_ids:
+        return f"user:{user['id']}"
+    # 權限變更只遞增 'users' 版本，不會清掉這裡；key 含系統清單，換了系統就重新查
+    own_key = ('own_outside', user['id'], systems)
+    own_outside = _bug_list_cache_get(own_key, version)
+    if own_outside is None:
+        own_outside = get_db_connection().execute('''
+            SELECT EXISTS (
+                SELECT 1 FROM bugs
+                WHERE reported_by_user_id = %s AND (system_id IS NULL OR NOT system_id = ANY(%s))
+            ) AS own_outside
+        ''', (user['id'], system_ids)).fetchone()['own_outside']
+        _bug_list_cache_put(own_key, version, own_outside)
+    return f"user:{user['id']}:systems:{systems}" if own_outside else f"systems:{systems}"
+
+def load_bug_list_page(user, query, sort, page_size, after, before):
+    """Run the list query; returns (bugs, has_next, has_prev)"""
+    conn = get_db_connection()
+    where_clauses = []
+    params = []
+    if query:
+        # search_text = system + bug_details + notes. pg_trgm cannot index
+        # 1-2 character patterns (most Chinese queries), so CJK bigrams are
+        # matched through the search_vector GIN index first; ILIKE rechecks
+        # the exact substring and uses the trigram index for longer queries.
+        filter_tsquery = build_search_filter_tsquery(query)
+        if filter_tsquery:
+            where_clauses.append("b.search_vector @@ to_tsquery('simple', %s)")
+            params.append(filter_tsquery)
+        where_clauses.append("b.search_text ILIKE %s ESCAPE '\\'")
+        params.append(f'%{escape_like(query)}%')
+    perm_clause, perm_params = build_bug_permission_filter(user)
+    if perm_clause:
+        where_clauses.append(perm_clause)
+        params += perm_params
+
+    sort_params = []
+    if sort == 'relevance':
+        tsquery = build_search_tsquery(query)
+        if tsquery:
+            sort_expr = "ts_rank(b.search_vector, to_tsquery('simple', %s))::float8"
+            sort_params.append(tsquery)
         else:
-            if is_admin(user):
-                bugs = conn.execute('''
-                    SELECT b.*, u.username as reporter_username 
-                    FROM bugs b LEFT JOIN users u ON b.reported_by_user_id = u.id
-                    ORDER BY b.report_date DESC
-                ''').fetchall()
-            else:
-                perm_clause, perm_params = build_permission_clause(user['id'], allowed_systems)
-                sql = f"SELECT b.*, u.username as reporter_username FROM bugs b LEFT JOIN users u ON b.reported_by_user_id = u.id WHERE {perm_clause} ORDER BY b.report_date DESC"
-                bugs = conn.execute(sql, tuple(perm_params)).fetchall()
+            sort_expr = '0::float8'
+    else:
+        sort_expr = 'b.report_date'
+
+    # Keyset pagination on (sort_key, id): "after" walks down the list,
+    # "before" walks back up (queried ascending, then reversed).
+    keyset_sql = ''
+    keyset_params = []
+    if after:
+        keyset_sql = 'WHERE (s.sort_key, s.id) < (%s, %s)'
+        keyset_params = list(after)
+        order = 's.sort_key DESC, s.id DESC'
+    elif before:
+        keyset_sql = 'WHERE (s.sort_key, s.id) > (%s, %s)'
+        keyset_params = list(before)
+        order = 's.sort_key ASC, s.id ASC'
+    else:
+        order = 's.sort_key DESC, s.id DESC'
 
-        conn.close()
+    where_sql = f"WHERE {' AND '.join(where_clauses)}" if where_clauses else ''
+    sql = f"""
+        SELECT * FROM (
+            SELECT {BUG_LIST_COLUMNS}, {sort_expr} AS sort_key
+            FROM bugs b LEFT JOIN users u ON b.reported_by_user_id = u.id
+            {where_sql}
+        ) s {keyset_sql}
+        ORDER BY {order} LIMIT %s
+    """
+    bugs = conn.execute(sql, tuple(sort_params + params + keyset_params + [page_size + 1])).fetchall()
 
-        bugs_with_permission = []
-        for bug in bugs:
-            bug_dict = dict(bug)
-            bug_dict['can_edit'] = can_edit_or_delete(bug, user)
-            bugs_with_permission.append(bug_dict)
-        
-        return render_template('index.html',
-                               bugs=bugs_with_permission,
-                               query=query,
-                               user=user,
-                               show_list=True)
+    has_more = len(bugs) > page_size
+    bugs = bugs[:page_size]
+    if before:
+        bugs.reverse()
+        has_next, has_prev = True, has_more
     else:
+        has_next, has_prev = has_more, after is not None
+
+    return bugs, has_next, has_prev
+
+def render_bug_rows(bugs, query):
+    """Render each row read-only and editable: [(reported_by_user_id, readonly_html, editable_html)]"""
+    bug_row = get_template_attribute('_bug_rows.html', 'bug_row')
+    return [(bug['reported_by_user_id'], bug_row(bug, query, False), bug_row(bug, query, True)) for bug in bugs]
+
+# 首頁 - 錯誤記錄列表（登入後才顯示記錄）
+@app.route('/', methods=['GET'])
+def index():
+    user = get_current_user()
+    if not user:
         return render_template('index.html',
-                               bugs=[],
+                               bug_rows=[],
                                query='',
                                user=None,
                                show_list=False)
 
+    # 列表內容只取決於可見範圍、bugs 資料版本（所有寫入路徑都會遞增，含刪除）與查詢參數
+    version = get_cache_version(get_db_connection(), 'bugs')
+    etag = page_etag('index', user['id'], permission_scope_key(user), version, request.query_string.decode())
+    cached = not_modified(etag)
+    if cached:
+        return cached
+
+    query = request.args.get('query', '').strip()
+    # 有搜尋條件時預設依相關度排序，否則依報告日期
+    sort = request.args.get('sort') or ('relevance' if query else 'date')
+    if sort not in ('date', 'relevance') or not query:
+        sort = 'date'
+    page_size = get_page_size()
+    after = decode_page_cursor(request.args.get('after'), sort)
+    before = None if after else decode_page_cursor(request.args.get('before'), sort)
+
+    cache_key = ('page', bug_list_scope_key(user, version), query, sort, page_size,
+                 'per_page' in request.args, after, before)
+    page = _bug_list_cache_get(cache_key, version)
+    if page is None:
+        bugs, has_next, has_prev = load_bug_list_page(user, query, sort, page_size, after, before)
+        page_args = {'query': query, 'sort': sort} if query else {}
+        if 'per_page' in request.args:
+            page_args['per_page'] = page_size
+        next_cursor = encode_page_cursor(bugs[-1]) if bugs and has_next else None
+        prev_cursor = encode_page_cursor(bugs[0]) if bugs and has_prev else None
+        page = {
+            'rows': render_bug_rows(bugs, query),
+            'next_url': url_for('index', after=next_cursor, **page_args) if next_cursor else None,
+            'prev_url': url_for('index', before=prev_cursor, **page_args) if prev_cursor else None,
+        }
+        _bug_list_cache_put(cache_key, version, page)
+
+    # 只有這一步依使用者而異：管理員或自己回報的記錄用可編輯版本
+    admin = is_admin(user)
+    bug_rows = [editable if admin or owner == user['id'] else readonly
+                for owner, readonly, editable in page['rows']]
+
+    return with_etag(render_template('index.html',
+                                     bug_rows=bug_rows,
+                                     query=query,
+                                     sort=sort,
+                                     user=user,
+                                     next_url=page['next_url'],
+                                     prev_url=page['prev_url'],
+                                     show_list=True), etag)
+
+# ---------------------------------------------
+# 附件：每個檔案一筆 attachments 記錄（storage_key 為 bucket 內路徑）
+# ---------------------------------------------
+def attachment_url(storage_key):
+    """Public URL for a bucket key; rows migrated from very old data may already hold an absolute URL"""
+    if storage_key.startswith(('http://', 'https://')):
+        return storage_key
+    return get_public_url(storage_key)
+
+def load_attachments(conn, bug_id):
+    """Attachments of one bug in upload order, with url / thumbnail_url for templates"""
+    rows = conn.execute('''
+        SELECT id, storage_key, content_type, thumbnail_key
+        FROM attachments WHERE bug_id = %s ORDER BY id
+    ''', (bug_id,)).fetchall()
+    return [dict(row, url=attachment_url(row['storage_key']),
+                 thumbnail_url=attachment_url(row['thumbnail_key']) if row['thumbnail_key'] else None)
+            for row in rows]
+
+def insert_attachment(conn, bug_id, info):
+    """Record one stored object on bug_id; returns the new id, or None if it was already attached"""
+    row = conn.execute('''
+        INSERT INTO attachments (bug_id, storage_key, size, content_type, content_hash, thumbnail_key)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        ON CONFLICT (bug_id, storage_key) DO NOTHING
+        RETURNING id
+    ''', (bug_id, info['storage_key'], info.get('size'), info.get('content_type'),
+          info.get('content_hash'), info.get('thumbnail_key'))).fetchone()
+    return row['id'] if row else None
+
+def upload_filename(raw_name):
+    """
+    secure_filename() that keeps the extension: it drops non-ASCII characters, so '截圖.png' would become 'png'.
+    Only the stem is sanitised; the extension comes from the raw name (build_storage_filename checks the allow-list).
+    """
+    stem, ext = os.path.splitext(raw_name)
+    ext = ext.lower()
+    if not re.fullmatch(r'\.[a-z0-9]+', ext):
+        ext = ''
+    return f"{secure_filename(stem) or 'file'}{ext}"
+
+def upload_request_files(bug_id):
+    """
+    Upload every file in request.files['file'] for bug_id; returns attachment info dicts in submission order.
+    Files that cannot reach Storage right now (StorageUnavailable) are queued in pending_uploads instead
+    (the caller commits); files Storage rejects are reported to the user straight away.
+    """
+    uploads = []  # (filename, stream)
+    seen = set()
+    for i, uploaded_file in enumerate(request.files.getlist('file')):
+        if uploaded_file and uploaded_file.filename:
+            filename = upload_filename(uploaded_file.filename)
+            # 同一批次同名檔案加上序號，避免在 Storage 產生相同的物件路徑
+            if filename in seen:
+                name, ext = os.path.splitext(filename)
+                filename = f"{name}_{i}{ext}"
+            seen.add(filename)
+            logger.info(f"Uploading file: {filename} (streamed)")
+            uploads.append((filename, uploaded_file.stream))
+
+    # Storage 斷路中：不再逐一等到逾時，直接排入佇列，記錄照常儲存
+    if uploads and not storage_available():
+        for filename, stream in uploads:
+            queue_upload(bug_id, filename, stream, 'Storage 暫時無法使用')
+        return []
+
+    # 直接把上傳串流轉送到 Storage，不再先存成暫存檔
+    results = upload_files_to_supabase([(stream, filename) for filename, stream in uploads],
+                                       bucket_folder=UPLOAD_BUCKET_FOLDER, upsert=False, bug_id=bug_id, details=True)
+
+    attachments = []
+    for (filename, stream), (success, result) in zip(uploads, results):
+        logger.info(f"Upload result for {filename}: success={success}, result={result}")
+        if success:
+            attachments.append(result)
+            flash(f'檔案 {filename} 上傳成功！', 'success')
+        elif isinstance(result, StorageUnavailable) and stream.seekable():
+            # 只有暫時性失敗（斷路、逾時、5xx）才排入佇列；4xx 等重試也不會成功的錯誤直接告知使用者
+            stream.seek(0)
+            queue_upload(bug_id, filename, stream, result)
+        else:
+            flash(f'檔案 {filename} 上傳失敗：{result}', 'error')
+            logger.error(f"File upload failed for {filename}: {result}")
+    return attachments
+
+# ---------------------------------------------
+# 延後上傳佇列：Storage 無法使用時先把檔案內容存進 pending_uploads，
+# 由背景執行緒在 Storage 恢復後上傳並補上附件記錄
+# ---------------------------------------------
+UPLOAD_QUEUE_INTERVAL = float(os.getenv('UPLOAD_QUEUE_INTERVAL', '30'))        # 背景重試間隔（秒）
+UPLOAD_QUEUE_MAX_ATTEMPTS = int(os.getenv('UPLOAD_QUEUE_MAX_ATTEMPTS', '10'))  # 超過後停止重試，資料保留供人工處理
+UPLOAD_QUEUE_LEASE = float(os.getenv('UPLOAD_QUEUE_LEASE', '600'))  # 領取後這麼久未完成（程序中途結束）才會被再次領取
+
+_upload_queue_thread = None
+_upload_queue_lock = threading.Lock()
+
+def queue_upload(bug_id, filename, stream, reason):
+    """Store a file that could not be uploaded in pending_uploads; returns False for files Storage would reject anyway"""
+    storage_filename, content_type = build_storage_filename(filename, UPLOAD_BUCKET_FOLDER, bug_id)
+    if storage_filename is None:
+        flash(f'檔案 {filename} 上傳失敗：{content_type}', 'error')
+        return False
+
+    get_db_connection().execute('''
+        INSERT INTO pending_uploads (bug_id, filename, content_type, data, last_error)
+        VALUES (%s, %s, %s, %s, %s)
+    ''', (bug_id, filename, content_type, stream.read(), str(reason)))
+    logger.warning(f"Queued upload of {filename} for bug {bug_id}: {reason}")
+    flash(f'檔案 {filename} 暫時無法上傳，已排入佇列稍後上傳', 'warning')
+    start_upload_queue_worker()
+    return True
+
+def _claim_queued_upload():
+    """Claim the next due pending_uploads row in a short transaction of its own; returns the row or None.
+
+    Claiming moves next_attempt_at UPLOAD_QUEUE_LEASE seconds ahead, which marks
+    the row in progress: other workers skip it, and it becomes due again if this
+    process dies mid-upload. No lock or transaction is held during the upload.
+    """
+    conn = get_db_connection_wrapper()
+    try:
+        # SKIP LOCKED：多個 worker 程序同時領取時不會拿到同一筆
+        row = conn.execute('''
+            UPDATE pending_uploads SET next_attempt_at = CURRENT_TIMESTAMP + make_interval(secs => %s)
+            WHERE id = (
+                SELECT id FROM pending_uploads
+                WHERE next_attempt_at <= CURRENT_TIMESTAMP
+                ORDER BY next_attempt_at, id
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, bug_id, filename, data, attempts
+        ''', (UPLOAD_QUEUE_LEASE,)).fetchone()
+        conn.commit()
+        return row
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def _record_queued_upload(row, success, result):
+    """Record the outcome of uploading a claimed row in a new short transaction"""
+    conn = get_db_connection_wrapper()
+    try:
+        if success:
+            # 上傳期間記錄可能已被刪除（pending_uploads 隨之 CASCADE 刪除）：此時不補附件
+            if conn.execute('DELETE FROM pending_uploads WHERE id = %s RETURNING id', (row['id'],)).fetchone():
+                if insert_attachment(conn, row['bug_id'], result):
+                    bump_cache_version(conn, 'bugs')
+        else:
+            # 暫時性失敗以指數退避重試（最長 1 小時）；達到上限或 Storage 拒收時
+            # next_attempt_at 設為 NULL，不再自動重試
+            attempts = row['attempts'] + 1
+            give_up = attempts >= UPLOAD_QUEUE_MAX_ATTEMPTS or not isinstance(result, StorageUnavailable)
+            conn.execute('''
+                UPDATE pending_uploads
+                SET attempts = %s, last_error = %s,
+                    next_attempt_at = CASE WHEN %s THEN NULL
+                                           ELSE CURRENT_TIMESTAMP + make_interval(secs => %s) END
+                WHERE id = %s
+            ''', (attempts, str(result), give_up, min(UPLOAD_QUEUE_INTERVAL * 2 ** attempts, 3600), row['id']))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def drain_upload_queue():
+    """Upload due pending_uploads rows one at a time until none are left or Storage is unavailable; returns the number uploaded"""
+    uploaded = 0
+    while storage_available():
+        row = _claim_queued_upload()
+        if row is None:
+            break
+
+        try:
+            success, result = upload_file_to_supabase(stream=io.BytesIO(bytes(row['data'])), filename=row['filename'],
+                                                      bucket_folder=UPLOAD_BUCKET_FOLDER, bug_id=row['bug_id'],
+                                                      details=True)
+        except StorageUnavailable as e:
+            success, result = False, e
+        _record_queued_upload(row, success, result)
+        if success:
+            uploaded += 1
+            logger.info(f"Uploaded queued file {row['filename']} for bug {row['bug_id']}")
+        else:
+            logger.error(f"Queued upload {row['id']} ({row['filename']}) failed, attempt {row['attempts'] + 1}: {result}")
+    return uploaded
+
+def _run_upload_queue():
+    while True:
+        time.sleep(UPLOAD_QUEUE_INTERVAL)
+        try:
+            drain_upload_queue()
+        except Exception:
+            logger.error('Draining upload queue failed', exc_info=True)
+
+# 每個 worker 程序處理第一個請求時啟動（fork 後的程序不會繼承執行緒），
+# 讓上一次執行留下的佇列也能被清空
+@app.before_request
+def start_upload_queue_worker():
+    """Start the background uploader once per process"""
+    global _upload_queue_thread
+    if _upload_queue_thread is not None:
+        return
+    with _upload_queue_lock:
+        if _upload_queue_thread is None:
+            _upload_queue_thread = threading.Thread(target=_run_upload_queue, name='upload-queue', daemon=True)
+            _upload_queue_thread.start()
+
+# ---------------------------------------------
+# 簽章直傳：瀏覽器向 /bug/<id>/uploads/sign 取得簽章網址後直接 PUT 到 Storage，
+# 再呼叫 /bug/<id>/uploads/confirm 把物件記錄到錯誤記錄上，檔案內容不經過 Flask
+# ---------------------------------------------
+DIRECT_UPLOAD_ENABLED = os.getenv('DIRECT_UPLOAD_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+UPLOAD_BUCKET_FOLDER = 'bug_reports'
+DIRECT_UPLOAD_GRANT_LIMIT = 20   # session 內最多保留幾筆「剛新增、可補傳檔案」的 bug ID
+DIRECT_UPLOAD_MAX_BYTES = int(os.getenv('DIRECT_UPLOAD_MAX_BYTES', str(20 * 1024 * 1024)))  # 直傳單檔上限
+DIRECT_UPLOAD_CONTENT_TYPES = ('image/jpeg', 'image/png')
+
+def grant_direct_upload(bug_id):
+    """Allow this session to attach files to a bug it just created (needed for anonymous reporters)"""
+    grants = [i for i in session.get('upload_grants', []) if i != bug_id]
+    session['upload_grants'] = (grants + [bug_id])[-DIRECT_UPLOAD_GRANT_LIMIT:]
+
+def direct_upload_urls(bug_id):
+    return {'sign_url': url_for('sign_bug_upload', bug_id=bug_id),
+            'confirm_url': url_for('confirm_bug_upload', bug_id=bug_id)}
+
+def direct_upload_payload():
+    """JSON object or form fields of a sign/confirm request; None for any other JSON body (e.g. a list)"""
+    payload = request.get_json(silent=True)
+    if payload is None:
+        return request.form
+    return payload if isinstance(payload, dict) else None
+
+def load_direct_upload_bug(bug_id):
+    """Return (bug, None) if the current session may attach files to bug_id, else (None, json error response)"""
+    if not DIRECT_UPLOAD_ENABLED:
+        return None, (jsonify({'error': '未啟用直傳上傳'}), 404)
+
+    bug = get_db_connection().execute(
+        'SELECT id, status, reported_by_user_id FROM bugs WHERE id = %s', (bug_id,)).fetchone()
+    if bug is None:
+        return None, (jsonify({'error': '找不到該錯誤記錄！'}), 404)
+
+    if bug_id in session.get('upload_grants', []):
+        return bug, None
+
+    user = get_current_user()
+    if not can_edit_or_delete(bug, user):
+        return None, (jsonify({'error': '您沒有權限上傳檔案到此記錄！'}), 403)
+    if bug['status'] in ['已解決', '已關閉']:
+        return None, (jsonify({'error': f'此錯誤記錄已「{bug["status"]}」，無法再新增檔案！'}), 409)
+    return bug, None
+
+# 取得簽章上傳網址
+@app.route('/bug/<int:bug_id>/uploads/sign', methods=['POST'])
+def sign_bug_upload(bug_id):
+    bug, error = load_direct_upload_bug(bug_id)
+    if error:
+        return error
+
+    payload = direct_upload_payload()
+    filename = payload.get('filename') if payload is not None else None
+    if not isinstance(filename, str) or not filename:
+        return jsonify({'error': '缺少檔名'}), 400
+    storage_filename, content_type = build_storage_filename(upload_filename(filename), UPLOAD_BUCKET_FOLDER, bug_id)
+    if storage_filename is None:
+        return jsonify({'error': content_type}), 400
+
+    # 斷路中直接請瀏覽器稍後再試，不讓每個檔案各自等到逾時
+    if not storage_available():
+        return jsonify({'error': 'Storage 暫時無法使用，請稍後再試'}), 503, {'Retry-After': str(int(STORAGE_BREAKER_RESET))}
+
+    success, result = create_signed_upload_url(storage_filename, upsert=False)
+    if not success:
+        logger.error(f"Signing upload for bug {bug_id} failed: {result}")
+        return jsonify({'error': result}), 502
+
+    logger.info(f"Issued signed upload for bug {bug_id}: {storage_filename}")
+    # 直傳檔名含 bug ID 與時間戳且不允許覆蓋，內容不會再變，可使用與內容雜湊命名相同的永久快取
+    return jsonify({'path': storage_filename, 'content_type': content_type,
+                    'cache_control': CONTENT_CACHE_CONTROL, **result})
+
+# 確認直傳完成，將物件記錄到錯誤記錄
+@app.route('/bug/<int:bug_id>/uploads/confirm', methods=['POST'])
+def confirm_bug_upload(bug_id):
+    bug, error = load_direct_upload_bug(bug_id)
+    if error:
+        return error
+
+    payload = direct_upload_payload()
+    path = payload.get('path') if payload is not None else None
+    if not isinstance(path, str):
+        return jsonify({'error': '檔案路徑不正確'}), 400
+    # 只接受本 bug 命名規則下、同一層資料夾的物件，避免把任意物件掛到記錄上
+    prefix = f"{UPLOAD_BUCKET_FOLDER}/bug_{bug_id}_"
+    if not path.startswith(prefix) or '/' in path[len(prefix):] or '..' in path:
+        return jsonify({'error': '檔案路徑不正確'}), 400
+
+    try:
+        info = storage_object_info(path)
+    except StorageUnavailable as e:
+        return jsonify({'error': str(e)}), 503, {'Retry-After': str(int(STORAGE_BREAKER_RESET))}
+    except Exception as e:
+        logger.error(f"Checking uploaded object {path} failed: {e}")
+        return jsonify({'error': f'無法確認檔案：{e}'}), 502
+    if info is None:
+        return jsonify({'error': '找不到已上傳的檔案'}), 404
+    # 簽章網址無法限制瀏覽器實際 PUT 的內容，記錄前再檢查 Storage 上的物件
+    content_type = (info['content_type'] or '').split(';')[0].strip().lower()
+    if content_type not in DIRECT_UPLOAD_CONTENT_TYPES:
+        return jsonify({'error': '只支援 jpg / jpeg / png 格式'}), 400
+    if info['size'] is None or info['size'] > DIRECT_UPLOAD_MAX_BYTES:
+        return jsonify({'error': f'檔案大小超過上限（{DIRECT_UPLOAD_MAX_BYTES // (1024 * 1024)} MB）'}), 413
+
+    conn = get_db_connection()
+    attachment_id = insert_attachment(conn, bug_id, {
+        'storage_key': path,
+        'size': info['size'],
+        'content_type': content_type,
+        'thumbnail_key': thumbnail_key(path),   # 由背景補上；完成前頁面以 onerror 退回原圖
+    })
+    if attachment_id:
+        bump_data_version()
+        schedule_thumbnail(path)
+    conn.commit()
+
+    logger.info(f"Confirmed direct upload for bug {bug_id}: {path}")
+    return jsonify({'id': attachment_id, 'url': get_public_url(path)})
+
 # 新增錯誤記錄（所有人皆可）
 @app.route('/add', methods=['GET', 'POST'])
 def add_bug():
@@ -170,67 +887,47 @@ def add_bug():
         notes = request.form.get('notes', '').strip()
         reported_by_user_id = user['id'] if user else None
 
+        # direct_upload=1：由前端取得 bug ID 後自行直傳檔案到 Storage，這裡改回傳 JSON
+        direct_upload = request.form.get('direct_upload') == '1'
+
         if status in ['已解決', '已關閉'] and not notes:
-            flash('當狀態設為「已解決」或「已關閉」時，必須填寫備註說明解決方式或關閉原因！', 'error')
-            return render_template('add.html', user=user)
+            error_msg = '當狀態設為「已解決」或「已關閉」時，必須填寫備註說明解決方式或關閉原因！'
+            if direct_upload:
+                return jsonify({'error': error_msg}), 400
+            flash(error_msg, 'error')
+            return render_template('add.html', user=user, direct_upload=DIRECT_UPLOAD_ENABLED)
 
-        # 先插入記錄以取得 bug ID
+        # 先插入記錄以取得 bug ID（RETURNING 一次取回，避免再查詢最新一筆）
         conn = get_db_connection()
-        conn.execute('''
+        new_bug = conn.execute(f'''
             INSERT INTO bugs 
-            (report_date, system, bug_details, reported_by, status, priority, severity, assigned_to, notes, reported_by_user_id, file_path)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        ''', (datetime.now(), system, bug_details, reported_by, status, priority, severity, assigned_to, notes, reported_by_user_id, None))
+            (report_date, system, bug_details, reported_by, status, priority, severity, assigned_to, notes, reported_by_user_id, system_id)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, {SYSTEM_ID_FOR_NAME_SQL})
+            RETURNING id
+        ''', (datetime.now(), system, bug_details, reported_by, status, priority, severity, assigned_to, notes, reported_by_user_id, system)).fetchone()
+        bump_data_version()
+        # 上傳檔案前先 commit，避免上傳期間持有未結束的交易
         conn.commit()
-        
-        # 取得新插入記錄的 ID
-        new_bug = conn.execute('SELECT id FROM bugs ORDER BY id DESC LIMIT 1').fetchone()
         bug_id = new_bug['id'] if new_bug else None
         
-        # 處理檔案上傳（可選，支援多個檔案）
-        file_paths_list = []
+        if direct_upload and bug_id:
+            grant_direct_upload(bug_id)
+            flash('記錄新增成功！')
+            return jsonify({'id': bug_id, 'redirect': url_for('index'), **direct_upload_urls(bug_id)})
+
+        # 處理檔案上傳（可選，支援多個檔案）；上傳 Storage 期間不佔用連線池的連線，完成後再取新連線寫入附件
         if bug_id:
-            uploaded_files = request.files.getlist('file')
-            for uploaded_file in uploaded_files:
-                if uploaded_file and uploaded_file.filename:
-                    try:
-                        filename = secure_filename(uploaded_file.filename)
-                        tmp_dir = tempfile.gettempdir()
-                        tmp_path = os.path.join(tmp_dir, f"upload_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{filename}")
-                        uploaded_file.save(tmp_path)
-                        
-                        logger.info(f"Uploading file: {filename} to {tmp_path}")
-
-                        success, result = upload_file_to_supabase(local_path=tmp_path, bucket_folder='bug_reports', upsert=False, bug_id=bug_id)
-                        logger.info(f"Upload result for {filename}: success={success}, result={result}")
-                        
-                        try:
-                            os.remove(tmp_path)
-                        except Exception:
-                            pass
-
-                        if success:
-                            file_paths_list.append(result)
-                            flash(f'檔案 {filename} 上傳成功！', 'success')
-                        else:
-                            flash(f'檔案 {filename} 上傳失敗：{result}', 'error')
-                            logger.error(f"File upload failed for {filename}: {result}")
-                    except Exception as e:
-                        error_msg = str(e)
-                        logger.error(f"File processing error for {filename}: {error_msg}", exc_info=True)
-                        flash(f'檔案 {filename} 處理失敗：{error_msg}', 'error')
-
-            # 更新記錄的檔案路徑
-            if file_paths_list:
-                file_paths_json = json.dumps(file_paths_list)
-                conn.execute('UPDATE bugs SET file_path = %s WHERE id = %s', (file_paths_json, bug_id))
-                conn.commit()
+            release_db_connection()
+            attachments = upload_request_files(bug_id)
+            conn = get_db_connection()
+            for attachment in attachments:
+                insert_attachment(conn, bug_id, attachment)
+            conn.commit()
 
-        conn.close()
         flash('記錄新增成功！')
         return redirect(url_for('index'))
 
-    return render_template('add.html', user=user)
+    return render_template('add.html', user=user, direct_upload=DIRECT_UPLOAD_ENABLED)
 
 # 編輯錯誤記錄（系統不可修改）
 @app.route('/edit/<int:id>', methods=['GET', 'POST'])
@@ -241,8 +938,7 @@ def edit_bug(id):
         return redirect(url_for('login'))
 
     conn = get_db_connection()
-    bug = conn.execute('SELECT * FROM bugs WHERE id = %s', (id,)).fetchone()
-    conn.close()
+    bug = conn.execute(f'SELECT {BUG_DETAIL_COLUMNS} FROM bugs WHERE id = %s', (id,)).fetchone()
 
     if bug is None:
         flash('找不到該錯誤記錄！')
@@ -256,13 +952,8 @@ def edit_bug(id):
         flash('您沒有權限編輯此記錄！', 'error')
         return redirect(url_for('index'))
 
-    # Parse file_path JSON for display
-    bug_dict = dict(bug)
-    try:
-        bug_dict['file_paths'] = json.loads(bug_dict.get('file_path')) if bug_dict.get('file_path') else []
-    except (json.JSONDecodeError, TypeError):
-        bug_dict['file_paths'] = [bug_dict.get('file_path')] if bug_dict.get('file_path') else []
-    bug = bug_dict
+    bug = dict(bug)
+    bug['attachments'] = load_attachments(conn, id)
 
     if request.method == 'POST':
         bug_details = request.form['bug_details'].strip()
@@ -275,72 +966,38 @@ def edit_bug(id):
 
         if status in ['已解決', '已關閉'] and not notes:
             flash('當狀態設為「已解決」或「已關閉」時，必須填寫備註！', 'error')
-            return render_template('edit.html', bug=bug, user=user)
+            return render_template('edit.html', bug=bug, user=user, direct_upload=DIRECT_UPLOAD_ENABLED)
 
         resolution_date = bug['resolution_date']
         if bug['status'] not in ['已解決', '已關閉'] and status in ['已解決', '已關閉']:
             resolution_date = datetime.now()
 
-        # 處理檔案上傳（可選，支援多個檔案）
-        file_paths_list = []
-        
-        # 保留既有檔案
-        try:
-            existing_paths = json.loads(bug.get('file_path')) if bug.get('file_path') else []
-            file_paths_list = existing_paths if isinstance(existing_paths, list) else []
-        except (json.JSONDecodeError, TypeError):
-            file_paths_list = [bug.get('file_path')] if bug.get('file_path') else []
-        
-        # 新增上傳的檔案
+        conn.execute('''
+            UPDATE bugs
+            SET bug_details = %s, reported_by = %s, status = %s, priority = %s, severity = %s,
+                assigned_to = %s, notes = %s, resolution_date = %s
+            WHERE id = %s
+        ''', (bug_details, reported_by, status, priority, severity, assigned_to, notes, resolution_date, id))
+        bump_data_version()
+        # 上傳檔案前先 commit，避免上傳期間持有未結束的交易
+        conn.commit()
+
+        # 新增上傳的檔案（可選，支援多個檔案；既有附件不受影響）
         uploaded_files = request.files.getlist('file')
         logger.info(f"[EDIT] Files received: {len(uploaded_files)} files")
         for i, f in enumerate(uploaded_files):
             logger.info(f"[EDIT] File {i}: filename={f.filename if f else 'None'}, content_type={f.content_type if f else 'None'}")
-        for uploaded_file in uploaded_files:
-            if uploaded_file and uploaded_file.filename:
-                try:
-                    filename = secure_filename(uploaded_file.filename)
-                    tmp_dir = tempfile.gettempdir()
-                    tmp_path = os.path.join(tmp_dir, f"upload_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{filename}")
-                    uploaded_file.save(tmp_path)
-                    
-                    logger.info(f"Uploading file: {filename} to {tmp_path}")
-
-                    success, result = upload_file_to_supabase(local_path=tmp_path, bucket_folder='bug_reports', upsert=False, bug_id=id)
-                    logger.info(f"Upload result for {filename}: success={success}, result={result}")
-                    
-                    try:
-                        os.remove(tmp_path)
-                    except Exception:
-                        pass
-
-                    if success:
-                        file_paths_list.append(result)
-                        flash(f'檔案 {filename} 上傳成功！', 'success')
-                    else:
-                        flash(f'檔案 {filename} 上傳失敗：{result}', 'error')
-                        logger.error(f"File upload failed for {filename}: {result}")
-                except Exception as e:
-                    error_msg = str(e)
-                    logger.error(f"File processing error for {filename}: {error_msg}", exc_info=True)
-                    flash(f'檔案 {filename} 處理失敗：{error_msg}', 'error')
-
-        # 將檔案路徑儲存為 JSON 陣列
-        file_paths_json = json.dumps(file_paths_list) if file_paths_list else None
-
+        # 上傳 Storage 期間不佔用連線池的連線，完成後再取新連線寫入附件
+        release_db_connection()
+        attachments = upload_request_files(id)
         conn = get_db_connection()
-        conn.execute('''
-            UPDATE bugs 
-            SET bug_details = %s, reported_by = %s, status = %s, priority = %s, severity = %s, 
-                assigned_to = %s, notes = %s, resolution_date = %s, file_path = %s
-            WHERE id = %s
-        ''', (bug_details, reported_by, status, priority, severity, assigned_to, notes, resolution_date, file_paths_json, id))
+        for attachment in attachments:
+            insert_attachment(conn, id, attachment)
         conn.commit()
-        conn.close()
         flash('記錄更新成功！')
         return redirect(url_for('index'))
 
-    return render_template('edit.html', bug=bug, user=user)
+    return render_template('edit.html', bug=bug, user=user, direct_upload=DIRECT_UPLOAD_ENABLED)
 
 
 # 檢視錯誤記錄（只讀檢視，顯示上傳的圖片/檔案）
@@ -348,64 +1005,54 @@ def edit_bug(id):
 def view_bug(id):
     user = get_current_user()
     conn = get_db_connection()
-    bug = conn.execute('SELECT * FROM bugs WHERE id = %s', (id,)).fetchone()
-    conn.close()
+    bug = conn.execute(f'SELECT {BUG_DETAIL_COLUMNS} FROM bugs WHERE id = %s', (id,)).fetchone()
 
     if bug is None:
         flash('找不到該錯誤記錄！', 'error')
         return redirect(url_for('index'))
 
+    # updated_at 由 trigger 維護，附件增刪也會更新
+    etag = page_etag('view', id, bug['updated_at'].isoformat(), user['id'] if user else None,
+                     can_edit_or_delete(bug, user))
+    cached = not_modified(etag)
+    if cached:
+        return cached
+
     # Determine if current user can edit/delete (for showing action buttons)
     bug_dict = dict(bug)
     bug_dict['can_edit'] = can_edit_or_delete(bug, user)
-    
-    # Parse file_path JSON
-    try:
-        bug_dict['file_paths'] = json.loads(bug_dict.get('file_path')) if bug_dict.get('file_path') else []
-    except (json.JSONDecodeError, TypeError):
-        # Fallback for old single-file format
-        bug_dict['file_paths'] = [bug_dict.get('file_path')] if bug_dict.get('file_path') else []
+    bug_dict['attachments'] = load_attachments(conn, id)
 
-    return render_template('view.html', bug=bug_dict, user=user)
+    return with_etag(render_template('view.html', bug=bug_dict, user=user), etag)
 
 # 刪除單個檔案
-@app.route('/delete_file/<int:bug_id>/<file_index>', methods=['POST'])
-def delete_file(bug_id, file_index):
+@app.route('/delete_file/<int:bug_id>/<int:attachment_id>', methods=['POST'])
+def delete_file(bug_id, attachment_id):
     user = get_current_user()
     if not user:
         flash('請先登入！', 'error')
         return redirect(url_for('login'))
 
     conn = get_db_connection()
-    bug = conn.execute('SELECT * FROM bugs WHERE id = %s', (bug_id,)).fetchone()
+    bug = conn.execute('SELECT id, reported_by_user_id FROM bugs WHERE id = %s', (bug_id,)).fetchone()
 
     if bug is None:
         flash('找不到該錯誤記錄！', 'error')
-        conn.close()
         return redirect(url_for('index'))
 
     if not can_edit_or_delete(bug, user):
         flash('您沒有權限刪除此檔案！', 'error')
-        conn.close()
         return redirect(url_for('view_bug', id=bug_id))
 
-    try:
-        file_index = int(file_index)
-        file_paths = json.loads(bug['file_path']) if bug.get('file_path') else []
-        
-        if 0 <= file_index < len(file_paths):
-            file_paths.pop(file_index)
-            file_paths_json = json.dumps(file_paths) if file_paths else None
-            
-            conn.execute('UPDATE bugs SET file_path = %s WHERE id = %s', (file_paths_json, bug_id))
-            conn.commit()
-            flash('檔案刪除成功！', 'success')
-        else:
-            flash('無法刪除該檔案！', 'error')
-    except (json.JSONDecodeError, ValueError):
-        flash('處理檔案時出錯！', 'error')
-    finally:
-        conn.close()
+    # 以附件 ID 刪除（Storage 物件保留：內容雜湊命名的檔案可能仍被其他記錄引用）
+    deleted = conn.execute('DELETE FROM attachments WHERE id = %s AND bug_id = %s RETURNING id',
+                           (attachment_id, bug_id)).fetchone()
+    if deleted:
+        bump_data_version()
+        conn.commit()
+        flash('檔案刪除成功！', 'success')
+    else:
+        flash('無法刪除該檔案！', 'error')
 
     return redirect(url_for('view_bug', id=bug_id))
 
@@ -418,16 +1065,16 @@ def delete_bug(id):
         return redirect(url_for('login'))
 
     conn = get_db_connection()
-    bug = conn.execute('SELECT * FROM bugs WHERE id = %s', (id,)).fetchone()
+    bug = conn.execute('SELECT id, reported_by_user_id FROM bugs WHERE id = %s', (id,)).fetchone()
 
     if bug and can_edit_or_delete(bug, user):
         conn.execute('DELETE FROM bugs WHERE id = %s', (id,))
+        bump_data_version()
         conn.commit()
         flash('錯誤記錄刪除成功！')
     else:
         flash('您沒有權限刪除此記錄！', 'error')
 
-    conn.close()
     return redirect(url_for('index'))
 
 # 使用者登入
@@ -438,7 +1085,6 @@ def login():
         password = request.form['password']
         conn = get_db_connection()
         user = conn.execute('SELECT * FROM users WHERE username = %s', (username,)).fetchone()
-        conn.close()
 
         if user and check_password_hash(user['password_hash'], password):
             # Check if user account is active
@@ -481,25 +1127,22 @@ def register():
                 return render_template('register.html')
 
             conn = get_db_connection()
-            try:
-                existing_user = conn.execute('SELECT * FROM users WHERE username = %s', (username,)).fetchone()
-                if existing_user:
-                    flash('此使用者名稱已被使用，請選擇其他名稱！', 'error')
-                    return render_template('register.html')
-
-                password_hash = generate_password_hash(password)
-                conn.execute('''
-                    INSERT INTO users (username, password_hash, is_admin)
-                    VALUES (%s, %s, FALSE)
-                ''', (username, password_hash))
-                conn.commit()
-                
-                logger.info(f"New user registered: {username}")
-                flash('註冊成功！請登入使用。', 'success')
-                return redirect(url_for('login'))
-            finally:
-                conn.close()
-                
+            existing_user = conn.execute('SELECT * FROM users WHERE username = %s', (username,)).fetchone()
+            if existing_user:
+                flash('此使用者名稱已被使用，請選擇其他名稱！', 'error')
+                return render_template('register.html')
+
+            password_hash = generate_password_hash(password)
+            conn.execute('''
+                INSERT INTO users (username, password_hash, is_admin)
+                VALUES (%s, %s, FALSE)
+            ''', (username, password_hash))
+            conn.commit()
+
+            logger.info(f"New user registered: {username}")
+            flash('註冊成功！請登入使用。', 'success')
+            return redirect(url_for('login'))
+
         except Exception as e:
             logger.error(f"Registration error for {username if 'username' in locals() else 'unknown'}: {str(e)}", exc_info=True)
             flash(f'註冊過程中發生錯誤: {str(e)}', 'error')
@@ -542,8 +1185,8 @@ def change_password():
         conn = get_db_connection()
         new_hash = generate_password_hash(new_password)
         conn.execute('UPDATE users SET password_hash = %s WHERE id = %s', (new_hash, user['id']))
+        invalidate_user_cache()
         conn.commit()
-        conn.close()
 
         flash('密碼變更成功！請重新登入。', 'success')
         session.clear()
@@ -563,7 +1206,6 @@ def admin_change_password(user_id):
     target_user = conn.execute('SELECT * FROM users WHERE id = %s', (user_id,)).fetchone()
     if target_user is None:
         flash('找不到該使用者！', 'error')
-        conn.close()
         return redirect(url_for('index'))
 
     if request.method == 'POST':
@@ -572,39 +1214,131 @@ def admin_change_password(user_id):
 
         if new_password != confirm_password:
             flash('兩次新密碼不一致！', 'error')
-            conn.close()
             return render_template('admin_change_password.html', target_user=target_user)
 
         if len(new_password) < 6:
             flash('新密碼長度至少需 6 個字元！', 'error')
-            conn.close()
             return render_template('admin_change_password.html', target_user=target_user)
 
         new_hash = generate_password_hash(new_password)
         conn.execute('UPDATE users SET password_hash = %s WHERE id = %s', (new_hash, user_id))
+        invalidate_user_cache()
         conn.commit()
-        conn.close()
 
         flash(f'已成功為使用者「{target_user["username"]}」變更密碼！', 'success')
         return redirect(url_for('index'))
 
-    conn.close()
     return render_template('admin_change_password.html', target_user=target_user)
 
-# 管理員 - 使用者管理頁面
+# 使用者管理頁：依 id 做 keyset 分頁，只取畫面顯示的欄位（不含 password_hash）
+ADMIN_USERS_PAGE_SIZE = int(os.getenv('ADMIN_USERS_PAGE_SIZE', '50'))
+USER_PERMISSION_FLAGS = ['is_admin', 'active'] + [code for code, _ in SYSTEMS]
+ADMIN_USER_COLUMNS = 'id, username, ' + ', '.join(USER_PERMISSION_FLAGS)
+
+# users 的模組旗標 → user_systems（與 migration 3 的回填規則相同）
+USER_SYSTEMS_FROM_FLAGS_SQL = '''
+    INSERT INTO user_systems (user_id, system_id)
+    SELECT u.id, s.id
+    FROM users u JOIN systems s ON ''' + ' OR '.join(f"(s.code = '{code}' AND u.{code})" for code, _ in SYSTEMS) + '''
+    WHERE u.id = ANY(%s)
+'''
+
+def apply_user_permissions(conn, changes):
+    """Apply {user_id: {flag: bool}} for all USER_PERMISSION_FLAGS in one UPDATE; returns the ids that actually changed"""
+    if not changes:
+        return []
+    flags = USER_PERMISSION_FLAGS
+    values_sql = ', '.join(['(%s::int' + ', %s::boolean' * len(flags) + ')'] * len(changes))
+    params = [value for user_id, new in changes.items() for value in [user_id] + [new[flag] for flag in flags]]
+    rows = conn.execute(f'''
+        UPDATE users u
+        SET {', '.join(f'{flag} = v.{flag}' for flag in flags)}
+        FROM (VALUES {values_sql}) AS v(id, {', '.join(flags)})
+        WHERE u.id = v.id
+          AND ({', '.join(f'u.{flag}' for flag in flags)}) IS DISTINCT FROM ({', '.join(f'v.{flag}' for flag in flags)})
+        RETURNING u.id
+    ''', tuple(params)).fetchall()
+    changed = [row['id'] for row in rows]
+    if changed:
+        # 同步 user_systems 對照表（列表/匯出的權限過濾以此為準）
+        conn.execute('DELETE FROM user_systems WHERE user_id = ANY(%s)', (changed,))
+        conn.execute(USER_SYSTEMS_FROM_FLAGS_SQL, (changed,))
+        invalidate_user_cache()
+    return changed
+
+# 管理員 - 使用者管理頁面（可搜尋、分頁，並可批次編輯權限）
 @app.route('/admin/users', methods=['GET'])
 def admin_users():
     user = get_current_user()
     if not user or not is_admin(user):
         flash('只有管理員才能訪問此頁面！', 'error')
         return redirect(url_for('index'))
-    
+
+    query = request.args.get('q', '').strip()
+    after = request.args.get('after', type=int)
+    before = None if after else request.args.get('before', type=int)
+
+    where_clauses, params = [], []
+    if query:
+        where_clauses.append("username ILIKE %s ESCAPE '\\'")
+        params.append(f'%{escape_like(query)}%')
+    if after:
+        where_clauses.append('id > %s')
+        params.append(after)
+    elif before:
+        where_clauses.append('id < %s')
+        params.append(before)
+    where_sql = f"WHERE {' AND '.join(where_clauses)}" if where_clauses else ''
+    # 往前翻頁時反向取資料，再轉回遞增順序
+    order = 'DESC' if before else 'ASC'
+
     conn = get_db_connection()
-    all_users = conn.execute('SELECT * FROM users ORDER BY id').fetchall()
-    conn.close()
-    
+    users = conn.execute(f'''
+        SELECT {ADMIN_USER_COLUMNS} FROM users {where_sql} ORDER BY id {order} LIMIT %s
+    ''', tuple(params + [ADMIN_USERS_PAGE_SIZE + 1])).fetchall()
+    has_more = len(users) > ADMIN_USERS_PAGE_SIZE
+    users = users[:ADMIN_USERS_PAGE_SIZE]
+    if before:
+        users.reverse()
+        has_next, has_prev = True, has_more
+    else:
+        has_next, has_prev = has_more, after is not None
+
+    page_args = {'q': query} if query else {}
+    next_url = url_for('admin_users', after=users[-1]['id'], **page_args) if users and has_next else None
+    prev_url = url_for('admin_users', before=users[0]['id'], **page_args) if users and has_prev else None
+
     # Pass `user` as well so base.html can detect login state and hide login button
-    return render_template('admin_users.html', users=all_users, current_user=user, user=user)
+    return render_template('admin_users.html', users=users, current_user=user, user=user, query=query,
+                           next_url=next_url, prev_url=prev_url, systems=SYSTEMS)
+
+# 管理員 - 批次更新使用者權限（一次送出整頁的勾選狀態，只更新有變更的使用者）
+@app.route('/admin/users/bulk', methods=['POST'])
+def admin_bulk_update_users():
+    user = get_current_user()
+    if not user or not is_admin(user):
+        flash('只有管理員才能執行此操作！', 'error')
+        return redirect(url_for('index'))
+
+    # 勾選框未勾選時不會送出，因此以 user_id 清單為準，勾選值為 <flag>_<user_id>
+    changes = {}
+    for value in request.form.getlist('user_id'):
+        try:
+            user_id = int(value)
+        except ValueError:
+            continue
+        changes[user_id] = {flag: f'{flag}_{user_id}' in request.form for flag in USER_PERMISSION_FLAGS}
+
+    try:
+        changed = apply_user_permissions(get_db_connection(), changes)
+        get_db_connection().commit()
+        flash(f'已更新 {len(changed)} 位使用者的權限！' if changed else '沒有需要更新的權限。', 'success')
+    except Exception as e:
+        logger.error(f"Error bulk updating users: {str(e)}")
+        flash(f'批次更新使用者權限失敗: {str(e)}', 'error')
+
+    return_args = {key: request.form[key] for key in ('q', 'after', 'before') if request.form.get(key)}
+    return redirect(url_for('admin_users', **return_args))
 
 
 # 管理員首頁（管理員專用的 Landing 頁面，未來可加入更多功能）
@@ -617,6 +1351,99 @@ def admin_landing():
 
     return render_template('admin_landing.html', user=user)
 
+# 管理員 - 統計儀表板（資料來自 bug_daily_stats 彙總表，由 bugs 的 trigger 即時維護，不掃描 bugs）
+ADMIN_DASHBOARD_RANGES = [(7, '近 7 天'), (30, '近 30 天'), (90, '近 90 天'), (365, '近一年'), (None, '全部')]
+
+@app.route('/admin/dashboard', methods=['GET'])
+def admin_dashboard():
+    user = get_current_user()
+    if not user or not is_admin(user):
+        flash('只有管理員才能訪問此頁面！', 'error')
+        return redirect(url_for('index'))
+
+    days = request.args.get('days', type=int)
+    if days not in [d for d, _ in ADMIN_DASHBOARD_RANGES]:
+        days = None
+    # 依報告日期篩選；最近趨勢至少顯示 30 天
+    range_sql, range_params = ('WHERE st.day > current_date - %s', [days]) if days else ('', [])
+    trend_days = days or 30
+
+    conn = get_db_connection()
+    rows = conn.execute(f'''
+        SELECT st.system_id, coalesce(s.name, '未分類') AS system_name, st.status, st.priority,
+               sum(st.bug_count) AS bug_count, sum(st.resolved_count) AS resolved_count,
+               sum(st.resolution_seconds) AS resolution_seconds
+        FROM bug_daily_stats st LEFT JOIN systems s ON s.id = st.system_id
+        {range_sql}
+        GROUP BY st.system_id, s.name, st.status, st.priority
+        HAVING sum(st.bug_count) <> 0
+        ORDER BY st.system_id
+    ''', tuple(range_params)).fetchall()
+    trend = conn.execute('''
+        SELECT st.day, sum(st.bug_count) AS bug_count
+        FROM bug_daily_stats st
+        WHERE st.day > current_date - %s
+        GROUP BY st.day
+        HAVING sum(st.bug_count) <> 0
+        ORDER BY st.day
+    ''', (trend_days,)).fetchall()
+
+    def bucket():
+        return {'bug_count': 0, 'resolved_count': 0, 'resolution_seconds': 0,
+                'statuses': dict.fromkeys(STATUSES, 0)}
+
+    totals, systems, by_priority = bucket(), {}, dict.fromkeys(PRIORITIES, 0)
+    for row in rows:
+        system = systems.setdefault(row['system_id'], dict(bucket(), name=row['system_name']))
+        for target in (totals, system):
+            target['bug_count'] += row['bug_count']
+            target['resolved_count'] += row['resolved_count']
+            target['resolution_seconds'] += row['resolution_seconds']
+            target['statuses'][row['status']] = target['statuses'].get(row['status'], 0) + row['bug_count']
+        by_priority[row['priority']] = by_priority.get(row['priority'], 0) + row['bug_count']
+    for target in [totals, *systems.values()]:
+        target['mean_resolution_seconds'] = (target['resolution_seconds'] / target['resolved_count']
+                                             if target['resolved_count'] else None)
+
+    return render_template('admin_dashboard.html', user=user, days=days, ranges=ADMIN_DASHBOARD_RANGES,
+                           totals=totals, systems=list(systems.values()), by_priority=by_priority,
+                           statuses=STATUSES, trend=trend, trend_max=max([r['bug_count'] for r in trend] or [0]))
+
+# 管理員 - 批次匯入錯誤記錄（CSV / xlsx，欄位與匯出報表相同）
+@app.route('/admin/import', methods=['GET', 'POST'])
+def admin_import():
+    user = get_current_user()
+    if not user or not is_admin(user):
+        flash('只有管理員才能訪問此頁面！', 'error')
+        return redirect(url_for('index'))
+
+    result = None
+    if request.method == 'POST':
+        uploaded_file = request.files.get('file')
+        if not uploaded_file or not uploaded_file.filename:
+            flash('請選擇要匯入的檔案！', 'error')
+            return render_template('admin_import.html', user=user, result=None)
+
+        dry_run = request.form.get('dry_run') == '1'
+        conn = get_db_connection()
+        try:
+            result = import_bugs(conn, uploaded_file.stream, uploaded_file.filename, dry_run=dry_run)
+            conn.commit()
+            result['dry_run'] = dry_run
+        except ImportFileError as e:
+            conn.rollback()
+            flash(f'匯入失敗：{e}', 'error')
+            return render_template('admin_import.html', user=user, result=None)
+
+        logger.info(f"Bulk import of {uploaded_file.filename} by {user['username']}: "
+                    f"{result['imported']} imported, {result['rejected_count']} rejected (dry_run={dry_run})")
+        if dry_run:
+            flash(f"驗證完成：{result['valid']} 筆可匯入，{result['rejected_count']} 筆有誤（未寫入資料庫）", 'success')
+        else:
+            flash(f"匯入完成：新增 {result['imported']} 筆，略過 {result['rejected_count']} 筆有誤的資料", 'success')
+
+    return render_template('admin_import.html', user=user, result=result)
+
 # 管理員 - 更新使用者權限
 @app.route('/admin/user/<int:user_id>', methods=['POST'])
 def admin_update_user(user_id):
@@ -627,22 +1454,9 @@ def admin_update_user(user_id):
     
     try:
         # Get form data for module access (checkboxes return 'on' if checked)
-        active = 'active' in request.form
-        m18 = 'm18' in request.form
-        eshop = 'eshop' in request.form
-        jetplus = 'jetplus' in request.form
-        sugarcrm = 'sugarcrm' in request.form
-        shopline = 'shopline' in request.form
-        is_admin_checkbox = 'is_admin' in request.form
-        
         conn = get_db_connection()
-        conn.execute('''
-            UPDATE users 
-            SET active = %s, m18 = %s, eshop = %s, jetplus = %s, sugarcrm = %s, shopline = %s, is_admin = %s
-            WHERE id = %s
-        ''', (active, m18, eshop, jetplus, sugarcrm, shopline, is_admin_checkbox, user_id))
+        apply_user_permissions(conn, {user_id: {flag: flag in request.form for flag in USER_PERMISSION_FLAGS}})
         conn.commit()
-        conn.close()
         
         flash('使用者權限已更新成功！', 'success')
     except Exception as e:
@@ -651,115 +1465,453 @@ def admin_update_user(user_id):
     
     return redirect(url_for('admin_users'))
 
-# 匯出 Excel 報表（僅登入使用者）
-@app.route('/export_excel')
-def export_excel():
-    user = get_current_user()
-    if not user:
-        flash('請先登入才能匯出報表！', 'error')
-        return redirect(url_for('login'))
+# 匯出設定：伺服器端游標每批筆數；欄寬依表頭與第一批資料估算
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', '2000'))
 
-    conn = get_db_connection()
+EXPORT_HEADERS = ['ID', '報告日期', '系統', '錯誤細節', '報告者', '報告者帳號', '狀態', '優先級', '嚴重程度', '指派給', '解決日期', '備註']
 
-    # Build permission filters similar to index()
-    allowed_systems = []
-    if user.get('m18'):
-        allowed_systems.append('m18')
-    if user.get('eshop'):
-        allowed_systems.append('eshop')
-    if user.get('jetplus'):
-        allowed_systems.append('jetplus')
-    if user.get('sugarcrm'):
-        allowed_systems.append('sugarcrm')
-    if user.get('shopline'):
-        allowed_systems.append('shopline')
-
-    def build_perm_clause_export(user_id, systems):
-        if systems:
-            system_clauses = ' OR '.join(['b.system ILIKE %s' for _ in systems])
-            clause = f"(b.reported_by_user_id = %s OR ({system_clauses}))"
-            params = [user_id] + [f'%{s}%' for s in systems]
-        else:
-            clause = "(b.reported_by_user_id = %s)"
-            params = [user_id]
-        return clause, params
-
-    if is_admin(user):
-        bugs = conn.execute('''
-            SELECT b.id, b.report_date, b.system, b.bug_details, b.reported_by,
-                   b.status, b.priority, b.severity, b.assigned_to, b.resolution_date, b.notes,
-                   u.username as reporter_username
-            FROM bugs b LEFT JOIN users u ON b.reported_by_user_id = u.id
-            ORDER BY b.report_date DESC
-        ''').fetchall()
-    else:
-        perm_clause, perm_params = build_perm_clause_export(user['id'], allowed_systems)
-        sql = f"SELECT b.id, b.report_date, b.system, b.bug_details, b.reported_by, b.status, b.priority, b.severity, b.assigned_to, b.resolution_date, b.notes, u.username as reporter_username FROM bugs b LEFT JOIN users u ON b.reported_by_user_id = u.id WHERE {perm_clause} ORDER BY b.report_date DESC"
-        bugs = conn.execute(sql, tuple(perm_params)).fetchall()
+EXPORT_COLORS = {
+    '開放中': 'FFFF99', '處理中': 'ADD8E6', '已解決': '90EE90', '已關閉': 'D3D3D3',
+    '低': 'D3D3D3', '中': 'ADD8E6', '高': 'FFB6C1',
+    '輕微': 'D3D3D3', '重大': 'FFFF99', '嚴重': 'FFB6C1',
+}
 
-    conn.close()
+def build_export_query(user, since=None):
+    """Return (sql, params) selecting the bugs user may export, newest first.
 
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "錯誤追蹤報表"
-
-    colors = {
-        '開放中': 'FFFF99', '處理中': 'ADD8E6', '已解決': '90EE90', '已關閉': 'D3D3D3',
-        '低': 'D3D3D3', '中': 'ADD8E6', '高': 'FFB6C1',
-        '輕微': 'D3D3D3', '中': 'ADD8E6', '重大': 'FFFF99', '嚴重': 'FFB6C1',
-    }
+    With since, only bugs reported or resolved at/after that time are included.
+    """
+    export_sql = '''
+        SELECT b.id, b.report_date, b.system, b.bug_details, b.reported_by,
+               b.status, b.priority, b.severity, b.assigned_to, b.resolution_date, b.notes,
+               u.username as reporter_username
+        FROM bugs b LEFT JOIN users u ON b.reported_by_user_id = u.id
+    '''
+    where_clauses, params = [], []
+    perm_clause, perm_params = build_bug_permission_filter(user)
+    if perm_clause:
+        where_clauses.append(perm_clause)
+        params += perm_params
+    if since:
+        where_clauses.append('(b.report_date >= %s OR b.resolution_date >= %s)')
+        params += [since, since]
+    if where_clauses:
+        export_sql += f" WHERE {' AND '.join(where_clauses)}"
+    export_sql += " ORDER BY b.report_date DESC, b.id DESC"
+    return export_sql, params
+
+def export_row_values(bug):
+    """Flatten a bug row into the export column layout (EXPORT_HEADERS)"""
+    # Format timestamps for display
+    report_date_str = bug['report_date'].strftime('%Y-%m-%d %H:%M:%S') if bug['report_date'] else ''
+    resolution_date_str = bug['resolution_date'].strftime('%Y-%m-%d %H:%M:%S') if bug['resolution_date'] else ''
+    return [
+        bug['id'], report_date_str, bug['system'], bug['bug_details'],
+        bug['reported_by'], bug['reporter_username'] or '（未登入使用者）',
+        bug['status'], bug['priority'], bug['severity'],
+        bug['assigned_to'] or '', resolution_date_str, bug['notes'] or ''
+    ]
+
+def write_bug_workbook(bugs, output):
+    """Write bug rows to output as an xlsx file using openpyxl's write-only mode.
+
+    Rows are streamed straight to disk, so memory does not grow with the row
+    count. Write-only sheets need column widths before the first row, so the
+    widths are estimated from the header and the first EXPORT_BATCH_SIZE rows.
+    """
+    # openpyxl 只有匯出會用到，延後到這裡才載入以縮短 worker 啟動時間
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Font, PatternFill, Alignment
+    from openpyxl.utils import get_column_letter
 
-    headers = ['ID', '報告日期', '系統', '錯誤細節', '報告者', '報告者帳號', '狀態', '優先級', '嚴重程度', '指派給', '解決日期', '備註']
-    ws.append(headers)
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("錯誤追蹤報表")
 
+    # Styles are created once and shared by every cell that uses them
     header_fill = PatternFill(start_color='4F81BD', end_color='4F81BD', fill_type='solid')
     header_font = Font(color='FFFFFF', bold=True)
-    for cell in ws[1]:
+    header_alignment = Alignment(horizontal='center', vertical='center')
+    fills = {color: PatternFill(start_color=color, end_color=color, fill_type='solid')
+             for color in set(EXPORT_COLORS.values()) | {'FFFFFF'}}
+
+    bugs = iter(bugs)
+    first_batch = [export_row_values(bug) for bug in islice(bugs, EXPORT_BATCH_SIZE)]
+
+    widths = [len(header) for header in EXPORT_HEADERS]
+    for values in first_batch:
+        for i, value in enumerate(values):
+            widths[i] = max(widths[i], len(str(value)))
+    for i, width in enumerate(widths):
+        ws.column_dimensions[get_column_letter(i + 1)].width = min(width + 2, 50)
+
+    header_cells = []
+    for header in EXPORT_HEADERS:
+        cell = WriteOnlyCell(ws, value=header)
         cell.fill = header_fill
         cell.font = header_font
-        cell.alignment = Alignment(horizontal='center', vertical='center')
+        cell.alignment = header_alignment
+        header_cells.append(cell)
+    ws.append(header_cells)
+
+    # 狀態 / 優先級 / 嚴重程度 columns (0-based 6..8) are colour-coded
+    for values in chain(first_batch, (export_row_values(bug) for bug in bugs)):
+        for i in (6, 7, 8):
+            cell = WriteOnlyCell(ws, value=values[i])
+            cell.fill = fills[EXPORT_COLORS.get(values[i], 'FFFFFF')]
+            values[i] = cell
+        ws.append(values)
 
-    for bug in bugs:
-        # Format timestamps for display
-        report_date_str = bug['report_date'].strftime('%Y-%m-%d %H:%M:%S') if bug['report_date'] else ''
-        resolution_date_str = bug['resolution_date'].strftime('%Y-%m-%d %H:%M:%S') if bug['resolution_date'] else ''
-        
-        row = [
-            bug['id'], report_date_str, bug['system'], bug['bug_details'],
-            bug['reported_by'], bug['reporter_username'] or '（未登入使用者）',
-            bug['status'], bug['priority'], bug['severity'],
-            bug['assigned_to'] or '', resolution_date_str, bug['notes'] or ''
-        ]
-        ws.append(row)
-
-        row_idx = ws.max_row
-        ws.cell(row=row_idx, column=7).fill = PatternFill(start_color=colors.get(bug['status'], 'FFFFFF'), end_color=colors.get(bug['status'], 'FFFFFF'), fill_type='solid')
-        ws.cell(row=row_idx, column=8).fill = PatternFill(start_color=colors.get(bug['priority'], 'FFFFFF'), end_color=colors.get(bug['priority'], 'FFFFFF'), fill_type='solid')
-        ws.cell(row=row_idx, column=9).fill = PatternFill(start_color=colors.get(bug['severity'], 'FFFFFF'), end_color=colors.get(bug['severity'], 'FFFFFF'), fill_type='solid')
-
-    for col in ws.columns:
-        max_length = 0
-        column = col[0].column_letter
-        for cell in col:
+    wb.save(output)
+
+# 匯出快照快取：以（權限範圍, 資料版本）為 key 存於磁碟，依總大小做 LRU 淘汰
+EXPORT_CACHE_DIR = os.getenv('EXPORT_CACHE_DIR') or os.path.join(tempfile.gettempdir(), 'bug_export_cache')
+EXPORT_CACHE_MAX_BYTES = int(os.getenv('EXPORT_CACHE_MAX_BYTES', str(512 * 1024 * 1024)))
+# 超過此筆數的匯出改由背景工作產生，頁面顯示進度並於完成後提供下載
+EXPORT_BACKGROUND_ROWS = int(os.getenv('EXPORT_BACKGROUND_ROWS', '20000'))
+
+# 背景工作狀態以快取檔旁的標記檔表示，所有 worker 程序都看得到：
+#   <path>.building  以 O_EXCL 建立，搶到的程序才產生報表；產生中持續更新 mtime
+#   <path>.failed    產生失敗，下一次匯出時清除後重試
+# .building 超過 EXPORT_JOB_STALE_SECONDS 未更新視為產生它的程序已結束（例如 worker 被回收）
+EXPORT_JOB_STALE_SECONDS = int(os.getenv('EXPORT_JOB_STALE_SECONDS', '120'))
+
+_export_executor = ThreadPoolExecutor(max_workers=int(os.getenv('EXPORT_JOB_WORKERS', '2')),
+                                      thread_name_prefix='export')
+
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+def permission_scope_key(user):
+    """Identify the set of bugs user can see.
+
+    Admins share one scope. Other users always see their own reports, so the
+    scope is their id plus the systems mapped to them.
+    """
+    if is_admin(user):
+        return 'admin'
+    system_ids = ','.join(str(i) for i in sorted(user.get('system_ids') or []))
+    return f"user:{user['id']}:systems:{system_ids}"
+
+def export_cache_path(user, version):
+    digest = hashlib.sha256(permission_scope_key(user).encode('utf-8')).hexdigest()[:32]
+    return os.path.join(EXPORT_CACHE_DIR, f'bugs_{digest}_v{version}.xlsx')
+
+def _export_cache_version(name, prefix):
+    """Data version of a cache file name in prefix's scope (bugs_<digest>_v), or None"""
+    if not name.startswith(prefix):
+        return None
+    version = name[len(prefix):].split('.', 1)[0]
+    return int(version) if version.isdigit() else None
+
+def _evict_export_cache(keep):
+    """Drop idle older versions of keep's scope, then least recently used files until under the size cap.
+
+    An older version used within EXPORT_JOB_STALE_SECONDS is kept: its
+    background job may have just finished, and the user who started it
+    downloads that snapshot by version (export_excel_snapshot).
+    """
+    prefix = os.path.basename(keep).rsplit('_v', 1)[0] + '_v'
+    keep_version = _export_cache_version(os.path.basename(keep), prefix)
+    now = time.time()
+    entries = []
+    for entry in os.scandir(EXPORT_CACHE_DIR):
+        version = _export_cache_version(entry.name, prefix)
+        older = version is not None and version < keep_version
+        if entry.name.endswith('.xlsx.failed'):
+            if older:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+            continue
+        if not entry.name.endswith('.xlsx') or entry.path == keep:
+            continue
+        try:
+            stat = entry.stat()
+            if older and now - stat.st_mtime >= EXPORT_JOB_STALE_SECONDS:
+                os.remove(entry.path)
+                continue
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    try:
+        total = os.path.getsize(keep) + sum(size for _, size, _ in entries)
+    except FileNotFoundError:
+        total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= EXPORT_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+def build_export_file(user, path, conn, wrap_rows=None):
+    """Write user's Excel export to path atomically, then apply cache eviction"""
+    os.makedirs(EXPORT_CACHE_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=EXPORT_CACHE_DIR, suffix='.tmp')
+    try:
+        export_sql, export_params = build_export_query(user)
+        rows = conn.stream(export_sql, tuple(export_params), batch_size=EXPORT_BATCH_SIZE)
+        with os.fdopen(fd, 'wb') as output:
+            write_bug_workbook(wrap_rows(rows) if wrap_rows else rows, output)
+        os.replace(tmp_path, path)
+    except Exception:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    _evict_export_cache(keep=path)
+
+def _export_marker_fresh(marker):
+    try:
+        return time.time() - os.path.getmtime(marker) < EXPORT_JOB_STALE_SECONDS
+    except FileNotFoundError:
+        return False
+
+def _claim_export_job(path):
+    """Create path's .building marker; False if another worker (or thread) already builds it"""
+    os.makedirs(EXPORT_CACHE_DIR, exist_ok=True)
+    marker = path + '.building'
+    for _ in range(2):
+        try:
+            os.close(os.open(marker, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            if _export_marker_fresh(marker):
+                return False
+            # 產生它的程序已不在：移除後重新搶一次
             try:
-                if len(str(cell.value)) > max_length:
-                    max_length = len(str(cell.value))
-            except:
+                os.remove(marker)
+            except FileNotFoundError:
                 pass
-        adjusted_width = min(max_length + 2, 50)
-        ws.column_dimensions[column].width = adjusted_width
+            continue
+        try:
+            os.remove(path + '.failed')
+        except FileNotFoundError:
+            pass
+        return True
+    return False
 
-    output = BytesIO()
-    wb.save(output)
-    output.seek(0)
+def _touch_every_batch(rows, marker):
+    """Pass rows through, refreshing marker's mtime every EXPORT_BATCH_SIZE rows"""
+    for i, row in enumerate(rows, start=1):
+        if i % EXPORT_BATCH_SIZE == 0:
+            try:
+                os.utime(marker)
+            except FileNotFoundError:
+                pass
+        yield row
 
-    return Response(
-        output,
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-        headers={
-            "Content-Disposition": f"attachment;filename=bug_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-        }
-    )
+def _build_export_in_background(user, path):
+    marker = path + '.building'
+    conn = get_db_connection_wrapper()
+    try:
+        build_export_file(user, path, conn, wrap_rows=lambda rows: _touch_every_batch(rows, marker))
+        conn.commit()
+    except Exception:
+        logger.error(f'Background export failed for {path}', exc_info=True)
+        with open(path + '.failed', 'w'):
+            pass
+        raise
+    finally:
+        conn.close()
+        try:
+            os.remove(marker)
+        except FileNotFoundError:
+            pass
+
+def _mark_export_used(path):
+    """Refresh a cached export's mtime, which orders LRU eviction"""
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+def _open_cached_export(path):
+    """Open a cached export and mark it recently used; None if it is not (or no longer) there"""
+    try:
+        output = open(path, 'rb')
+    except FileNotFoundError:
+        return None
+    _mark_export_used(path)
+    return output
+
+def _export_download_name():
+    return f"bug_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
+
+def _export_job_status(path):
+    """Return 'ready', 'pending', 'failed' or None (no cached file and no job), as seen by any worker"""
+    if os.path.exists(path):
+        return 'ready'
+    if _export_marker_fresh(path + '.building'):
+        return 'pending'
+    if os.path.exists(path + '.failed'):
+        return 'failed'
+    return None
+
+def _export_row_count_exceeds(conn, user, limit):
+    export_sql, export_params = build_export_query(user)
+    row = conn.execute(f"SELECT count(*) AS n FROM (SELECT 1 FROM ({export_sql}) e LIMIT %s) s",
+                       tuple(export_params) + (limit + 1,)).fetchone()
+    return row['n'] > limit
+
+# 匯出 Excel 報表（僅登入使用者）
+@app.route('/export_excel')
+def export_excel():
+    user = get_current_user()
+    if not user:
+        flash('請先登入才能匯出報表！', 'error')
+        return redirect(url_for('login'))
+
+    conn = get_db_connection()
+    # 背景工作以開始時的資料版本為 ID：之後即使資料再有寫入，進度與下載仍指向同一份快照
+    version = get_cache_version(conn, 'bugs')
+    path = export_cache_path(user, version)
+
+    output = _open_cached_export(path)
+    if output is None:
+        status = _export_job_status(path)
+        if status == 'pending':
+            return render_template('export_status.html', user=user, export_job=version)
+        if status == 'failed':
+            try:
+                os.remove(path + '.failed')
+            except FileNotFoundError:
+                pass
+            flash('背景產生報表失敗，請重新匯出！', 'error')
+            return redirect(url_for('index'))
+
+        if _export_row_count_exceeds(conn, user, EXPORT_BACKGROUND_ROWS):
+            if _claim_export_job(path):
+                _export_executor.submit(_build_export_in_background, dict(user), path)
+            return render_template('export_status.html', user=user, export_job=version)
+
+        build_export_file(user, path, conn)
+        output = _open_cached_export(path)
+        if output is None:
+            # Evicted by a concurrent request before it could be opened: rebuild into a throwaway file
+            output = tempfile.TemporaryFile()
+            export_sql, export_params = build_export_query(user)
+            write_bug_workbook(conn.stream(export_sql, tuple(export_params), batch_size=EXPORT_BATCH_SIZE), output)
+            output.seek(0)
+
+    return send_file(output, mimetype=XLSX_MIMETYPE, as_attachment=True, download_name=_export_download_name())
+
+# 背景匯出狀態（供匯出進度頁輪詢）；job 為 export_excel 開始工作時的資料版本
+@app.route('/export_excel/status/<int:job>')
+def export_excel_status(job):
+    user = get_current_user()
+    if not user:
+        return jsonify({'status': 'unauthorized'}), 401
+    path = export_cache_path(user, job)
+    status = _export_job_status(path)
+    if status == 'ready':
+        # 等待下載期間不被較新版本的產生過程淘汰
+        _mark_export_used(path)
+    return jsonify({'status': status or 'missing'})
+
+# 下載背景工作產生的快照（路徑只由目前使用者的權限範圍與 job 決定）
+@app.route('/export_excel/<int:job>')
+def export_excel_snapshot(job):
+    user = get_current_user()
+    if not user:
+        flash('請先登入才能匯出報表！', 'error')
+        return redirect(url_for('login'))
+    output = _open_cached_export(export_cache_path(user, job))
+    if output is None:
+        flash('報表已過期，請重新匯出！', 'error')
+        return redirect(url_for('export_excel'))
+    return send_file(output, mimetype=XLSX_MIMETYPE, as_attachment=True, download_name=_export_download_name())
+
+# 串流匯出（CSV / NDJSON）：每累積約 EXPORT_CHUNK_BYTES 送出一段
+EXPORT_CHUNK_BYTES = 64 * 1024
+
+def _csv_lines(bugs):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_HEADERS)
+    yield buffer.getvalue()
+    for bug in bugs:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow(export_row_values(bug))
+        yield buffer.getvalue()
+
+def _ndjson_lines(bugs):
+    for bug in bugs:
+        record = {key: value.isoformat() if isinstance(value, datetime) else value for key, value in bug.items()}
+        yield json.dumps(record, ensure_ascii=False) + '\n'
+
+def _chunked(lines, compress):
+    """Group text lines into ~EXPORT_CHUNK_BYTES byte chunks, optionally gzip-compressed"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    pending, size = [], 0
+    for line in lines:
+        data = line.encode('utf-8')
+        pending.append(data)
+        size += len(data)
+        if size >= EXPORT_CHUNK_BYTES:
+            chunk = b''.join(pending)
+            pending, size = [], 0
+            chunk = compressor.compress(chunk) if compressor else chunk
+            if chunk:
+                yield chunk
+    chunk = b''.join(pending)
+    if compressor:
+        chunk = compressor.compress(chunk) + compressor.flush()
+    if chunk:
+        yield chunk
+
+def _stream_export(fmt):
+    user = get_current_user()
+    if not user:
+        flash('請先登入才能匯出報表！', 'error')
+        return redirect(url_for('login'))
+
+    since = request.args.get('since')
+    if since:
+        try:
+            since = datetime.fromisoformat(since)
+        except ValueError:
+            abort(400, description='since 參數格式錯誤，請使用 ISO 8601（例如 2026-01-31 或 2026-01-31T08:00:00+08:00）')
+
+    export_sql, export_params = build_export_query(user, since=since)
+    bugs = get_db_connection().stream(export_sql, tuple(export_params), batch_size=EXPORT_BATCH_SIZE)
+
+    if fmt == 'csv':
+        lines, mimetype = _csv_lines(bugs), 'text/csv'
+    else:
+        lines, mimetype = _ndjson_lines(bugs), 'application/x-ndjson'
+
+    compress = 'gzip' in request.headers.get('Accept-Encoding', '').lower() and request.args.get('gzip') != '0'
+    headers = {
+        "Content-Disposition": f"attachment;filename=bug_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{fmt}",
+        "Vary": "Accept-Encoding",
+    }
+    if compress:
+        headers["Content-Encoding"] = "gzip"
+
+    # stream_with_context 讓請求範圍的資料庫連線在串流結束後才歸還
+    return Response(stream_with_context(_chunked(lines, compress)),
+                    mimetype=mimetype, headers=headers)
+
+# 串流匯出 CSV（欄位與 Excel 報表相同，供 BI / 匯入使用）
+@app.route('/export.csv')
+def export_csv():
+    return _stream_export('csv')
+
+# 串流匯出 NDJSON（每行一筆 JSON，欄位為資料庫欄位名稱）
+@app.route('/export.ndjson')
+def export_ndjson():
+    return _stream_export('ndjson')
+
+# 冷啟動時間（import 到此的耗時），用來追蹤啟動速度是否退步
+STARTUP_SECONDS = time.perf_counter() - _STARTUP_STARTED
+app.config['STARTUP_SECONDS'] = STARTUP_SECONDS
+logger.info(f"App module loaded in {STARTUP_SECONDS * 1000:.0f} ms (pid {os.getpid()})")
 
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
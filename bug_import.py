@@ -0,0 +1,270 @@
+"""
+Bulk import of bug records from CSV or xlsx files in the export layout.
+
+Files produced by /export_excel and /export.csv can be loaded back as-is;
+files from other trackers only need the same header names. Rows are read
+and validated one at a time, valid rows are spooled to a CSV buffer and
+loaded with a single COPY into a temporary staging table, then inserted
+into bugs in one statement, all inside one transaction. Usage:
+
+    python bug_import.py bugs.xlsx             # import, print rejected rows
+    python bug_import.py bugs.csv --dry-run    # validate only, change nothing
+
+The ID column is ignored (imported bugs get new IDs). 報告者帳號 is matched
+to users.username; unknown accounts are imported without a user link.
+"""
+
+import argparse
+import csv
+import io
+import os
+import sys
+import tempfile
+from datetime import datetime
+
+from db_supabase import get_db_connection_wrapper, bump_cache_version, SYSTEMS
+
+# Header names of the export layout -> bugs column (None = ignored)
+IMPORT_COLUMNS = {
+    'ID': None,
+    '報告日期': 'report_date',
+    '系統': 'system',
+    '錯誤細節': 'bug_details',
+    '報告者': 'reported_by',
+    '報告者帳號': 'reporter_username',
+    '狀態': 'status',
+    '優先級': 'priority',
+    '嚴重程度': 'severity',
+    '指派給': 'assigned_to',
+    '解決日期': 'resolution_date',
+    '備註': 'notes',
+}
+REQUIRED_HEADERS = ('系統', '錯誤細節', '報告者')
+
+STATUSES = ('開放中', '處理中', '已解決', '已關閉')
+PRIORITIES = ('低', '中', '高')
+SEVERITIES = ('輕微', '中', '重大', '嚴重')
+
+# Placeholder the export writes for bugs reported without logging in
+ANONYMOUS_REPORTER = '（未登入使用者）'
+
+DATE_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d', '%Y/%m/%d %H:%M:%S', '%Y/%m/%d')
+
+# Only the first rejected rows are kept with their reasons; all are counted
+IMPORT_REJECT_LIMIT = int(os.getenv('IMPORT_REJECT_LIMIT', '1000'))
+
+# Column order of the staging table and of the spooled COPY data
+STAGING_COLUMNS = ('line', 'report_date', 'system', 'bug_details', 'reported_by', 'reporter_username',
+                   'status', 'priority', 'severity', 'assigned_to', 'resolution_date', 'notes')
+
+
+class ImportFileError(ValueError):
+    """The file as a whole cannot be imported (unknown format, missing headers)"""
+
+
+def _cell_text(value):
+    if value is None:
+        return ''
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
+
+def _parse_date(value):
+    if isinstance(value, datetime):
+        return value
+    text = _cell_text(value)
+    if not text:
+        return None
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, fmt)
+        except ValueError:
+            pass
+    return datetime.fromisoformat(text)
+
+
+def iter_file_rows(stream, filename):
+    """Yield (line_number, [cell, ...]) from a CSV or xlsx binary stream, header row included"""
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == '.csv':
+        # utf-8-sig also accepts the BOM Excel adds when saving CSV
+        text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+        try:
+            yield from enumerate(csv.reader(text), start=1)
+        finally:
+            text.detach()
+    elif ext == '.xlsx':
+        # openpyxl 只有匯入 / 匯出會用到，延後載入；read_only 模式逐列讀取，不把整張表載入記憶體
+        from openpyxl import load_workbook
+        workbook = load_workbook(stream, read_only=True, data_only=True)
+        try:
+            yield from enumerate(workbook.active.iter_rows(values_only=True), start=1)
+        finally:
+            workbook.close()
+    else:
+        raise ImportFileError('只支援 .csv 或 .xlsx 檔案')
+
+
+def _header_positions(header_row):
+    positions = {}
+    for i, cell in enumerate(header_row):
+        name = _cell_text(cell)
+        if name in IMPORT_COLUMNS and IMPORT_COLUMNS[name]:
+            positions[IMPORT_COLUMNS[name]] = i
+    missing = [name for name in REQUIRED_HEADERS if IMPORT_COLUMNS[name] not in positions]
+    if missing:
+        raise ImportFileError(f"缺少必要欄位：{'、'.join(missing)}（請使用匯出報表的欄位名稱）")
+    return positions
+
+
+def validate_row(values):
+    """Return (record, None) for a valid row dict keyed by bugs column, or (None, reason)"""
+    record = {column: _cell_text(value) for column, value in values.items()}
+
+    for name in REQUIRED_HEADERS:
+        if not record.get(IMPORT_COLUMNS[name]):
+            return None, f'「{name}」不可空白'
+
+    system = record['system'].lower()
+    if not any(code in system for code, _ in SYSTEMS):
+        return None, f"未知的系統「{record['system']}」"
+
+    record['status'] = record.get('status') or '開放中'
+    record['priority'] = record.get('priority') or '中'
+    record['severity'] = record.get('severity') or '中'
+    for column, label, allowed in (('status', '狀態', STATUSES), ('priority', '優先級', PRIORITIES),
+                                   ('severity', '嚴重程度', SEVERITIES)):
+        if record[column] not in allowed:
+            return None, f"{label}「{record[column]}」不正確，應為 {'/'.join(allowed)}"
+
+    if record['status'] in ('已解決', '已關閉') and not record.get('notes'):
+        return None, '狀態為「已解決」或「已關閉」時必須有備註'
+
+    for column, label in (('report_date', '報告日期'), ('resolution_date', '解決日期')):
+        try:
+            record[column] = _parse_date(values.get(column))
+        except ValueError:
+            return None, f"{label}「{record.get(column)}」格式錯誤"
+    record['report_date'] = record['report_date'] or datetime.now()
+
+    if record.get('reporter_username') == ANONYMOUS_REPORTER:
+        record['reporter_username'] = ''
+    return record, None
+
+
+def import_bugs(conn, stream, filename, dry_run=False):
+    """
+    Validate every row of the file and load the valid ones into bugs in the
+    caller's transaction (the caller commits). Returns
+    {'total', 'valid', 'imported', 'rejected_count', 'rejected': [(line, reason), ...]}.
+    Raises ImportFileError if the file itself is unusable.
+    """
+    rows = iter_file_rows(stream, filename)
+    header = next(rows, None)
+    if header is None:
+        raise ImportFileError('檔案是空的')
+    positions = _header_positions(header[1])
+
+    total, valid, rejected_count, rejected = 0, 0, 0, []
+    # 通過驗證的資料先寫進暫存檔（小檔留在記憶體），再一次 COPY 進資料庫
+    with tempfile.SpooledTemporaryFile(max_size=16 * 1024 * 1024, mode='w+', newline='', encoding='utf-8') as buffer:
+        writer = csv.writer(buffer)
+        for line, row in rows:
+            if not any(_cell_text(cell) for cell in row):
+                continue
+            total += 1
+            values = {column: row[i] if i < len(row) else None for column, i in positions.items()}
+            record, reason = validate_row(values)
+            if record is None:
+                rejected_count += 1
+                if len(rejected) < IMPORT_REJECT_LIMIT:
+                    rejected.append((line, reason))
+                continue
+            valid += 1
+            record['line'] = line
+            # COPY CSV: 未加引號的空欄位為 NULL
+            writer.writerow(['' if record.get(column) is None else record.get(column, '')
+                             for column in STAGING_COLUMNS])
+
+        imported = 0
+        if valid and not dry_run:
+            buffer.seek(0)
+            imported = _copy_into_bugs(conn, buffer)
+
+    return {'total': total, 'imported': imported, 'valid': valid,
+            'rejected_count': rejected_count, 'rejected': rejected}
+
+
+def _copy_into_bugs(conn, buffer):
+    """COPY the spooled rows into a temp staging table, then insert them into bugs; returns the row count"""
+    cursor = conn.conn.cursor()
+    try:
+        cursor.execute('''
+            CREATE TEMP TABLE bug_import_staging (
+                line INTEGER,
+                report_date TIMESTAMPTZ,
+                system TEXT,
+                bug_details TEXT,
+                reported_by TEXT,
+                reporter_username TEXT,
+                status TEXT,
+                priority TEXT,
+                severity TEXT,
+                assigned_to TEXT,
+                resolution_date TIMESTAMPTZ,
+                notes TEXT
+            ) ON COMMIT DROP
+        ''')
+        cursor.copy_expert(f"COPY bug_import_staging ({', '.join(STAGING_COLUMNS)}) FROM STDIN WITH (FORMAT csv)",
+                           buffer)
+        # system_id 的對應規則與 SYSTEM_ID_FOR_NAME_SQL 相同
+        cursor.execute('''
+            INSERT INTO bugs (report_date, system, bug_details, reported_by, status, priority, severity,
+                              assigned_to, resolution_date, notes, reported_by_user_id, system_id)
+            SELECT st.report_date, st.system, st.bug_details, st.reported_by, st.status, st.priority, st.severity,
+                   st.assigned_to, st.resolution_date, st.notes, u.id,
+                   (SELECT s.id FROM systems s WHERE st.system ILIKE '%' || s.code || '%' ORDER BY s.id LIMIT 1)
+            FROM bug_import_staging st
+            LEFT JOIN users u ON u.username = st.reporter_username
+            ORDER BY st.line
+        ''')
+        imported = cursor.rowcount
+        cursor.execute('DROP TABLE bug_import_staging')
+    finally:
+        cursor.close()
+    if imported:
+        bump_cache_version(conn, 'bugs')
+    return imported
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import bugs from a CSV or xlsx file in the export layout')
+    parser.add_argument('file', help='path to a .csv or .xlsx file')
+    parser.add_argument('--dry-run', action='store_true', help='validate rows without importing them')
+    args = parser.parse_args()
+
+    conn = get_db_connection_wrapper()
+    try:
+        with open(args.file, 'rb') as f:
+            result = import_bugs(conn, f, args.file, dry_run=args.dry_run)
+        conn.commit()
+    except ImportFileError as e:
+        conn.rollback()
+        print(f"Import failed: {e}", file=sys.stderr)
+        sys.exit(1)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    for line, reason in result['rejected']:
+        print(f"Rejected line {line}: {reason}", file=sys.stderr)
+    if result['rejected_count'] > len(result['rejected']):
+        print(f"... {result['rejected_count'] - len(result['rejected'])} more rejected rows not shown", file=sys.stderr)
+    action = 'Validated' if args.dry_run else 'Imported'
+    count = result['valid'] if args.dry_run else result['imported']
+    print(f"{action} {count} of {result['total']} rows, {result['rejected_count']} rejected.")
@@ -2,7 +2,9 @@ import psycopg2
 from psycopg2.extras import RealDictCursor
 from dotenv import load_dotenv
 import os
-from datetime import datetime
+import threading
+import time
+import uuid
 
 load_dotenv()
 
@@ -18,6 +20,14 @@ SUPABASE_DB = os.getenv('SUPABASE_DB', 'postgres')
 SUPABASE_USER = os.getenv('SUPABASE_USER')
 SUPABASE_PASSWORD = os.getenv('SUPABASE_PASSWORD')
 
+# Connection pool settings (seconds for timeouts / lifetimes)
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', '1'))
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', '10'))
+DB_POOL_IDLE_TIMEOUT = float(os.getenv('DB_POOL_IDLE_TIMEOUT', '300'))
+DB_POOL_MAX_LIFETIME = float(os.getenv('DB_POOL_MAX_LIFETIME', '1800'))
+DB_POOL_CHECKOUT_TIMEOUT = float(os.getenv('DB_POOL_CHECKOUT_TIMEOUT', '30'))
+DB_POOL_CHECK_IDLE = float(os.getenv('DB_POOL_CHECK_IDLE', '30'))
+
 def get_db_connection():
     """Create and return a PostgreSQL database connection"""
     try:
@@ -47,6 +57,221 @@ def get_db_connection():
         print(f"Database connection error: {e}")
         raise
 
+class PooledConnection:
+    """Bookkeeping for a raw psycopg2 connection owned by the pool"""
+    def __init__(self, pg_conn):
+        self.pg_conn = pg_conn
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+
+class ConnectionPool:
+    """Thread-safe pool of psycopg2 connections.
+
+    - min_size connections are kept open, up to max_size are created on demand
+    - connections idle longer than idle_timeout are closed (above min_size)
+    - connections older than max_lifetime are replaced on checkout/checkin
+    - a connection idle longer than check_idle gets a SELECT 1 on checkout
+      so a dropped Supabase connection is replaced instead of handed to a
+      request; recently used ones skip the round trip
+    """
+    def __init__(self, connect=get_db_connection, min_size=DB_POOL_MIN_SIZE,
+                 max_size=DB_POOL_MAX_SIZE, idle_timeout=DB_POOL_IDLE_TIMEOUT,
+                 max_lifetime=DB_POOL_MAX_LIFETIME, checkout_timeout=DB_POOL_CHECKOUT_TIMEOUT,
+                 check_idle=DB_POOL_CHECK_IDLE):
+        if max_size < 1 or min_size < 0 or min_size > max_size:
+            raise ValueError(f"Invalid pool size: min={min_size}, max={max_size}")
+        self._connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.checkout_timeout = checkout_timeout
+        self.check_idle = check_idle
+        self._idle = []          # LIFO stack of PooledConnection
+        self._in_use = {}        # id(pg_conn) -> PooledConnection
+        self._size = 0           # idle + in use + being opened
+        self._cond = threading.Condition()
+        self._closed = False
+
+    def _open(self):
+        return PooledConnection(self._connect())
+
+    def _discard(self, pooled):
+        try:
+            pooled.pg_conn.close()
+        except psycopg2.Error as e:
+            print(f"Error closing pooled connection: {e}")
+
+    def _expired(self, pooled, now):
+        return self.max_lifetime and now - pooled.created_at > self.max_lifetime
+
+    def _healthy(self, pooled, now):
+        pg_conn = pooled.pg_conn
+        if pg_conn.closed:
+            return False
+        if now - pooled.last_used <= self.check_idle:
+            return True
+        try:
+            # Idle connections returned by checkin are never inside a transaction,
+            # so SELECT 1 + rollback leaves no trace.
+            with pg_conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            pg_conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _prune_idle(self, now):
+        """Close idle connections past idle_timeout / max_lifetime. Caller holds the lock."""
+        keep, drop = [], []
+        for pooled in self._idle:
+            idle_too_long = self.idle_timeout and now - pooled.last_used > self.idle_timeout
+            if self._expired(pooled, now) or (idle_too_long and self._size - len(drop) > self.min_size):
+                drop.append(pooled)
+            else:
+                keep.append(pooled)
+        self._idle = keep
+        self._size -= len(drop)
+        return drop
+
+    def getconn(self):
+        """Check out a healthy raw psycopg2 connection, blocking up to checkout_timeout"""
+        deadline = time.monotonic() + self.checkout_timeout
+        while True:
+            with self._cond:
+                if self._closed:
+                    raise psycopg2.OperationalError('Connection pool is closed')
+                drop = self._prune_idle(time.monotonic())
+                pooled = None
+                create = False
+                if self._idle:
+                    pooled = self._idle.pop()
+                elif self._size < self.max_size:
+                    self._size += 1
+                    create = True
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not self._cond.wait(remaining):
+                        if not self._idle and self._size >= self.max_size:
+                            raise psycopg2.OperationalError(
+                                f'Timed out after {self.checkout_timeout}s waiting for a database connection '
+                                f'(pool max_size={self.max_size})'
+                            )
+            for stale in drop:
+                self._discard(stale)
+
+            if create:
+                try:
+                    pooled = self._open()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            elif pooled is None:
+                continue
+            elif not self._healthy(pooled, time.monotonic()):
+                self._discard(pooled)
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                continue
+
+            with self._cond:
+                self._in_use[id(pooled.pg_conn)] = pooled
+            return pooled.pg_conn
+
+    def putconn(self, pg_conn, discard=False):
+        """Return a connection to the pool (rolled back), or close it if broken/expired"""
+        with self._cond:
+            pooled = self._in_use.pop(id(pg_conn), None)
+        if pooled is None:
+            # Not ours (or already returned); just close it.
+            self._discard(PooledConnection(pg_conn))
+            return
+
+        now = time.monotonic()
+        if not discard and not pg_conn.closed:
+            try:
+                # Never hand an open transaction to the next borrower
+                if pg_conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    pg_conn.rollback()
+            except psycopg2.Error:
+                discard = True
+        if discard or pg_conn.closed or self._closed or self._expired(pooled, now):
+            self._discard(pooled)
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            return
+
+        pooled.last_used = now
+        with self._cond:
+            self._idle.append(pooled)
+            self._cond.notify()
+
+    def fill(self):
+        """Open connections until min_size is reached"""
+        while True:
+            with self._cond:
+                if self._closed or self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                pooled = self._open()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                raise
+            with self._cond:
+                self._idle.append(pooled)
+                self._cond.notify()
+
+    def closeall(self):
+        """Close every idle connection and refuse further checkouts"""
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for pooled in idle:
+            self._discard(pooled)
+
+    def stats(self):
+        with self._cond:
+            return {'size': self._size, 'idle': len(self._idle), 'in_use': len(self._in_use),
+                    'min_size': self.min_size, 'max_size': self.max_size}
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """Return the process-wide connection pool, creating it on first use"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool()
+    return _pool
+
+def close_pool():
+    """Close the process-wide pool (e.g. at worker shutdown)"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+def _forget_pool_after_fork():
+    # A forked worker must not use (or close) the parent's sockets: closing
+    # would send Terminate on the parent's sessions. Drop the references and
+    # let the child build its own pool on first use.
+    global _pool, _pool_lock
+    _pool = None
+    _pool_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_forget_pool_after_fork)
+
 def dict_factory(cursor, row):
     """Convert database row to dictionary"""
     d = {}
@@ -85,9 +310,10 @@ class Row:
 
 class Connection:
     """Wrapper around psycopg2 connection to provide sqlite3-like interface"""
-    def __init__(self, pg_conn):
+    def __init__(self, pg_conn, pool=None):
         self.conn = pg_conn
         self.cursor = None
+        self.pool = pool
     
     def execute(self, query, params=None):
         """Execute a query and return self for method chaining"""
@@ -104,6 +330,27 @@ class Connection:
             raise
         return self
     
+    def stream(self, query, params=None, batch_size=2000):
+        """Yield rows from a named server-side cursor, fetching batch_size rows per round trip.
+
+        Keeps memory flat for large result sets; must be consumed inside the
+        current transaction.
+        """
+        cursor = self.conn.cursor(name=f'stream_{uuid.uuid4().hex}', cursor_factory=RealDictCursor)
+        cursor.itersize = batch_size
+        try:
+            try:
+                cursor.execute(query, params)
+            except psycopg2.Error as e:
+                print(f"Database execution error: {e}")
+                print(f"Query: {query}")
+                print(f"Params: {params}")
+                raise
+            for row in cursor:
+                yield row
+        finally:
+            cursor.close()
+    
     def fetchone(self):
         """Fetch one row as dictionary"""
         if self.cursor:
@@ -125,14 +372,33 @@ class Connection:
             self.conn.rollback()
             raise
     
+    def rollback(self):
+        """Roll back the current transaction"""
+        try:
+            self.conn.rollback()
+        except psycopg2.Error as e:
+            print(f"Database rollback error: {e}")
+            raise
+
     def close(self):
-        """Close the connection"""
+        """Close the connection (pooled connections are returned to the pool)"""
+        if self.conn is None:
+            return
         try:
             if self.cursor:
                 self.cursor.close()
-            self.conn.close()
+                self.cursor = None
+        except psycopg2.Error as e:
+            print(f"Error closing cursor: {e}")
+        try:
+            if self.pool is not None:
+                self.pool.putconn(self.conn)
+            else:
+                self.conn.close()
         except psycopg2.Error as e:
             print(f"Error closing connection: {e}")
+        finally:
+            self.conn = None
     
     @property
     def row_factory(self):
@@ -145,60 +411,57 @@ class Connection:
         pass
 
 def get_db_connection_wrapper():
-    """Get a connection wrapper that mimics sqlite3 interface"""
-    pg_conn = get_db_connection()
-    return Connection(pg_conn)
+    """Get a pooled connection wrapper that mimics sqlite3 interface"""
+    pool = get_pool()
+    return Connection(pool.getconn(), pool)
+
+def get_cache_version(conn, name):
+    """Return the current version stamp for a cached data set (0 if never bumped)"""
+    row = conn.execute('SELECT version FROM cache_versions WHERE name = %s', (name,)).fetchone()
+    return row['version'] if row else 0
+
+def bump_cache_version(conn, name):
+    """Increment the version stamp for a cached data set and return the new value.
+
+    Runs inside the caller's transaction so the bump becomes visible to other
+    workers together with the data change it describes.
+    """
+    row = conn.execute('''
+        INSERT INTO cache_versions (name, version) VALUES (%s, 1)
+        ON CONFLICT (name) DO UPDATE SET version = cache_versions.version + 1
+        RETURNING version
+    ''', (name,)).fetchone()
+    return row['version']
+
+# Systems known to the tracker: (code, display name). The code matches the
+# module flag column on users and is matched case-insensitively inside the
+# free-text bugs.system value.
+SYSTEMS = [
+    ('m18', 'M18'),
+    ('eshop', 'eShop'),
+    ('jetplus', 'Jetplus/MePOS'),
+    ('sugarcrm', 'SugarCRM'),
+    ('shopline', 'Shopline'),
+]
+
+# Resolve a free-text system name (the %s parameter) to systems.id
+SYSTEM_ID_FOR_NAME_SQL = "(SELECT s.id FROM systems s WHERE %s ILIKE '%%' || s.code || '%%' ORDER BY s.id LIMIT 1)"
+
+# Text covered by search (system, bug_details, notes); shared by the generated
+# search_text / search_vector columns
+BUG_SEARCH_DOCUMENT = "coalesce(system, '') || E'\\n' || coalesce(bug_details, '') || E'\\n' || coalesce(notes, '')"
 
 # Initialize database schema if needed
-def init_db():
-    """Initialize database schema"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
+def init_db(dry_run=False):
+    """Initialize / upgrade the database schema by applying pending migrations"""
+    from migrations import run_migrations
+
     try:
-        # Create users table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id SERIAL PRIMARY KEY,
-                username TEXT UNIQUE NOT NULL,
-                password_hash TEXT NOT NULL,
-                is_admin BOOLEAN DEFAULT FALSE,
-                active BOOLEAN DEFAULT TRUE,
-                m18 BOOLEAN DEFAULT FALSE,
-                eshop BOOLEAN DEFAULT FALSE,
-                jetplus BOOLEAN DEFAULT FALSE,
-                sugarcrm BOOLEAN DEFAULT FALSE,
-                shopline BOOLEAN DEFAULT FALSE
-            )
-        ''')
-        
-        # Create bugs table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS bugs (
-                id SERIAL PRIMARY KEY,
-                report_date TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
-                system TEXT NOT NULL,
-                bug_details TEXT NOT NULL,
-                reported_by TEXT NOT NULL,
-                status TEXT DEFAULT '開放中',
-                priority TEXT DEFAULT '中',
-                severity TEXT DEFAULT '中',
-                assigned_to TEXT,
-                resolution_date TIMESTAMPTZ,
-                notes TEXT,
-                reported_by_user_id INTEGER REFERENCES users(id),
-                file_path TEXT
-            )
-        ''')
-        
-        conn.commit()
-        print("Database schema initialized successfully!")
+        run_migrations(dry_run=dry_run)
+        if not dry_run:
+            print("Database schema initialized successfully!")
     except Exception as e:
         print(f"Error initializing database: {e}")
-        conn.rollback()
-    finally:
-        cursor.close()
-        conn.close()
 
 if __name__ == '__main__':
     # Test connection
@@ -0,0 +1,93 @@
+"""
+Gunicorn settings for the production image (gunicorn -c gunicorn.conf.py wsgi:app).
+
+Every setting can be overridden from the environment; the defaults are the
+tuning used in the Docker image.
+
+Database connections: each worker process has its own DB pool, so the
+database sees up to
+
+    workers x DB_POOL_MAX_SIZE
+
+connections from this server. DB_MAX_CONNECTIONS (default 40, leaving
+headroom under the smallest Supabase plan's 60 direct connections for
+migrations, the dashboard and other clients) is that budget. A worker's
+pool must hold one connection per request thread plus the background
+export jobs (EXPORT_JOB_WORKERS) and the deferred-upload queue thread,
+otherwise requests wait on checkout; so unless set explicitly the worker
+count is how many such pools fit in the budget, and each pool gets its
+share of it (DB_MAX_CONNECTIONS // workers). Settings that exceed the
+budget or starve the pool are logged as a warning at startup.
+
+Graceful reload: `kill -HUP <master pid>` starts new workers and lets the old
+ones finish in-flight requests (up to graceful_timeout). With
+GUNICORN_PRELOAD=true the code is imported once in the master, which starts
+workers faster and shares memory, but HUP then reuses the already-loaded
+code; deploy new code by restarting the container instead.
+"""
+
+import multiprocessing
+import os
+
+bind = os.getenv('GUNICORN_BIND', f"0.0.0.0:{os.getenv('PORT', '5000')}")
+
+# 多程序 pre-fork，每個 worker 內再以執行緒處理並行請求（等待 DB / Storage 時不佔住整個程序）
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', '4'))
+
+# 每個 worker 同時可能用到的連線：每個請求執行緒一條、背景匯出 EXPORT_JOB_WORKERS 條、延後上傳佇列一條
+EXPORT_JOB_WORKERS = int(os.getenv('EXPORT_JOB_WORKERS', '2'))
+_min_pool_size = threads + EXPORT_JOB_WORKERS + 1
+
+# 所有 worker 的 DB 連線總數上限；預設 worker 數為預算內可容納幾個上述大小的連線池
+DB_MAX_CONNECTIONS = int(os.getenv('DB_MAX_CONNECTIONS', '40'))
+workers = int(os.getenv('WEB_CONCURRENCY') or
+              max(1, min(multiprocessing.cpu_count() * 2 + 1, DB_MAX_CONNECTIONS // _min_pool_size)))
+
+# 未指定連線池大小時依 worker 數平分預算（不少於 _min_pool_size）；worker 在 fork 後才 import db_supabase，會讀到這裡的預設值
+os.environ.setdefault('DB_POOL_MAX_SIZE', str(max(_min_pool_size, DB_MAX_CONNECTIONS // workers)))
+
+# 處理 N 個請求後換新 worker（加 jitter 避免所有 worker 同時重啟），控制長時間執行的記憶體成長
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', '1000'))
+max_requests_jitter = int(os.getenv('GUNICORN_MAX_REQUESTS_JITTER', '100'))
+
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '60'))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', '30'))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', '5'))
+
+preload_app = os.getenv('GUNICORN_PRELOAD', 'false').lower() in ('1', 'true', 'yes')
+
+accesslog = os.getenv('GUNICORN_ACCESS_LOG', '-')
+errorlog = '-'
+loglevel = os.getenv('GUNICORN_LOG_LEVEL', 'info')
+
+# 反向代理（負載平衡器）送來的 X-Forwarded-* 只在信任的來源採用
+forwarded_allow_ips = os.getenv('FORWARDED_ALLOW_IPS', '127.0.0.1')
+
+
+def on_starting(server):
+    per_worker = int(os.environ['DB_POOL_MAX_SIZE'])
+    server.log.info(f"DB connections: {workers} workers x {per_worker} = up to {workers * per_worker} "
+                    f"(DB_MAX_CONNECTIONS={DB_MAX_CONNECTIONS})")
+    if workers * per_worker > DB_MAX_CONNECTIONS:
+        server.log.warning("WEB_CONCURRENCY x DB_POOL_MAX_SIZE exceeds DB_MAX_CONNECTIONS; "
+                           "lower them or raise DB_MAX_CONNECTIONS to match the database's connection limit")
+    if per_worker < _min_pool_size:
+        server.log.warning(f"DB_POOL_MAX_SIZE={per_worker} is below GUNICORN_THREADS + EXPORT_JOB_WORKERS + 1 "
+                           f"({_min_pool_size}); requests will wait for connections under load")
+
+
+def post_worker_init(worker):
+    # fork 後的 worker 不會沿用 master 的連線（db_supabase / tt 以 register_at_fork 丟棄），
+    # 這裡先開好 DB_POOL_MIN_SIZE 條連線，第一個請求不必等連線建立
+    import db_supabase
+    try:
+        db_supabase.get_pool().fill()
+    except Exception as e:
+        # 資料庫暫時連不上時照樣啟動，第一次使用時再連
+        worker.log.warning(f"DB pool warm-up failed in worker {worker.pid}: {e}")
+
+
+def worker_exit(server, worker):
+    import db_supabase
+    db_supabase.close_pool()
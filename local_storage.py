@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+本機開發用的 Supabase Storage 替身伺服器（只實作本專案用到的 API）
+檔案存放在 LOCAL_STORAGE_DIR，啟動後把 .env 的 SUPABASE_URL 指向它即可測試上傳流程：
+
+    python local_storage.py            # 預設 http://127.0.0.1:54321
+    SUPABASE_URL=http://127.0.0.1:54321 python app.py
+"""
+
+import os
+import json
+import secrets
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, unquote
+
+LOCAL_STORAGE_DIR  = os.getenv("LOCAL_STORAGE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".local_storage"))
+LOCAL_STORAGE_HOST = os.getenv("LOCAL_STORAGE_HOST", "127.0.0.1")
+LOCAL_STORAGE_PORT = int(os.getenv("LOCAL_STORAGE_PORT", "54321"))
+
+PREFIX = "/storage/v1/"
+CHUNK_SIZE = 64 * 1024
+META_SUFFIX = ".meta.json"
+
+
+class StorageHandler(BaseHTTPRequestHandler):
+    """
+    POST /storage/v1/object/<bucket>/<path>              直接上傳（需 Authorization）
+    POST /storage/v1/object/upload/sign/<bucket>/<path>  申請簽章上傳網址
+    PUT  /storage/v1/object/upload/sign/<bucket>/<path>?token=...  以簽章網址上傳
+    HEAD /storage/v1/object/<bucket>/<path>              物件是否存在
+    GET  /storage/v1/object/<bucket>/<path>              下載物件（需 Authorization）
+    GET  /storage/v1/object/public/<bucket>/<path>       下載公開物件
+    """
+    signed_tokens = {}   # token → bucket/path（程序內有效）
+
+    # ---------- 共用 ----------
+    def _route(self):
+        parts = urlsplit(self.path)
+        if not parts.path.startswith(PREFIX):
+            return None, {}
+        return unquote(parts.path[len(PREFIX):]), parse_qs(parts.query)
+
+    def _file_path(self, key):
+        """bucket/path → 本機檔案路徑；不允許跳出 LOCAL_STORAGE_DIR"""
+        root = os.path.normpath(LOCAL_STORAGE_DIR)
+        path = os.path.normpath(os.path.join(root, key))
+        return path if path.startswith(root + os.sep) else None
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self._cors_headers()
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _cors_headers(self):
+        # 瀏覽器從 Flask 頁面直接 PUT 到這裡，需要允許跨來源
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("Access-Control-Allow-Methods", "GET, HEAD, POST, PUT, OPTIONS")
+        self.send_header("Access-Control-Allow-Headers", "authorization, apikey, content-type, cache-control, x-upsert")
+
+    def _authorized(self):
+        return self.headers.get("Authorization", "").startswith("Bearer ")
+
+    def _meta(self, path):
+        try:
+            with open(path + META_SUFFIX) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"content_type": "application/octet-stream", "cache_control": "max-age=3600"}
+
+    def _save_body(self, key, upsert):
+        path = self._file_path(key)
+        if path is None:
+            return self._send_json(400, {"error": "Invalid key"})
+        if os.path.exists(path) and not upsert:
+            return self._send_json(400, {"statusCode": "409", "error": "Duplicate", "message": "The resource already exists"})
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            for chunk in self._iter_body():
+                f.write(chunk)
+        # 與 Storage 相同：保存上傳時的 content-type / cache-control，下載時原樣回傳
+        with open(path + META_SUFFIX, "w") as f:
+            json.dump({"content_type": self.headers.get("Content-Type", "application/octet-stream"),
+                       "cache_control": self.headers.get("Cache-Control", "max-age=3600")}, f)
+        self._send_json(200, {"Key": key})
+
+    def _iter_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            while True:
+                size = int(self.rfile.readline().split(b";")[0].strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return
+                yield self.rfile.read(size)
+                self.rfile.readline()
+        remaining = int(self.headers.get("Content-Length") or 0)
+        while remaining > 0:
+            chunk = self.rfile.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                return
+            yield chunk
+            remaining -= len(chunk)
+
+    # ---------- HTTP methods ----------
+    def do_OPTIONS(self):
+        self.send_response(204)
+        self._cors_headers()
+        self.end_headers()
+
+    def do_POST(self):
+        route, _ = self._route()
+        if route is None or not self._authorized():
+            return self._send_json(401, {"error": "Unauthorized"})
+        if route.startswith("object/upload/sign/"):
+            key = route[len("object/upload/sign/"):]
+            token = secrets.token_urlsafe(24)
+            self.signed_tokens[token] = key
+            return self._send_json(200, {"url": f"/object/upload/sign/{key}?token={token}"})
+        if route.startswith("object/"):
+            upsert = self.headers.get("x-upsert", "false") == "true"
+            return self._save_body(route[len("object/"):], upsert)
+        self._send_json(404, {"error": "Not found"})
+
+    def do_PUT(self):
+        route, query = self._route()
+        if route is None or not route.startswith("object/upload/sign/"):
+            return self._send_json(404, {"error": "Not found"})
+        key = route[len("object/upload/sign/"):]
+        token = (query.get("token") or [""])[0]
+        if self.signed_tokens.get(token) != key:
+            return self._send_json(400, {"error": "Invalid signature"})
+        self._save_body(key, self.headers.get("x-upsert", "false") == "true")
+
+    def do_HEAD(self):
+        route, _ = self._route()
+        path = self._file_path(route[len("object/"):]) if route and route.startswith("object/") else None
+        if path is None or not os.path.isfile(path):
+            self.send_response(400)
+            self._cors_headers()
+            self.end_headers()
+            return
+        self.send_response(200)
+        self._cors_headers()
+        self.send_header("Content-Type", self._meta(path)["content_type"])
+        self.send_header("Content-Length", str(os.path.getsize(path)))
+        self.end_headers()
+
+    def do_GET(self):
+        route, _ = self._route()
+        if route is None or not route.startswith("object/"):
+            return self._send_json(404, {"error": "Not found"})
+        if route.startswith("object/public/"):
+            key = route[len("object/public/"):]
+        elif self._authorized():
+            key = route[len("object/"):]
+        else:
+            return self._send_json(401, {"error": "Unauthorized"})
+        path = self._file_path(key)
+        if path is None or not os.path.isfile(path):
+            return self._send_json(400, {"error": "Object not found"})
+        meta = self._meta(path)
+        self.send_response(200)
+        self._cors_headers()
+        self.send_header("Content-Type", meta["content_type"])
+        self.send_header("Cache-Control", meta["cache_control"])
+        self.send_header("Content-Length", str(os.path.getsize(path)))
+        self.end_headers()
+        with open(path, "rb") as f:
+            while chunk := f.read(CHUNK_SIZE):
+                self.wfile.write(chunk)
+
+
+def make_server(host=LOCAL_STORAGE_HOST, port=LOCAL_STORAGE_PORT):
+    os.makedirs(LOCAL_STORAGE_DIR, exist_ok=True)
+    return ThreadingHTTPServer((host, port), StorageHandler)
+
+
+if __name__ == "__main__":
+    server = make_server()
+    print(f"本機 Storage 替身：http://{server.server_address[0]}:{server.server_address[1]}")
+    print(f"  檔案目錄 : {LOCAL_STORAGE_DIR}")
+    server.serve_forever()
@@ -0,0 +1,553 @@
+"""
+Versioned schema migrations for the bug tracker database.
+
+Each migration runs once, in version order, and is recorded in the
+schema_migrations table. Usage:
+
+    python migrations.py             # apply pending migrations
+    python migrations.py --dry-run   # print what would run, change nothing
+
+Migrations marked transactional=False run statement by statement outside a
+transaction, which is required for CREATE INDEX CONCURRENTLY so that indexes
+can be added to production tables without blocking writes.
+"""
+
+import argparse
+import re
+import textwrap
+
+import psycopg2
+
+from db_supabase import get_db_connection, SYSTEMS, BUG_SEARCH_DOCUMENT
+
+# pg_advisory_lock key so concurrent deploys / workers never migrate in parallel
+MIGRATION_LOCK_ID = 7_310_001
+
+
+class Migration:
+    """One schema change: an ordered list of SQL statements (or (sql, params) pairs)"""
+    def __init__(self, version, name, statements, transactional=True):
+        self.version = version
+        self.name = name
+        self.statements = statements
+        self.transactional = transactional
+
+
+def _bug_stats_upsert(source, sign):
+    """SQL adding (sign=1) or removing (sign=-1) the bug_daily_stats contribution of the bugs rows in source"""
+    return f'''
+        INSERT INTO bug_daily_stats AS s (day, system_id, status, priority, bug_count, resolved_count, resolution_seconds)
+        SELECT coalesce(report_date::date, DATE '1970-01-01'), coalesce(system_id, 0),
+               coalesce(status, ''), coalesce(priority, ''),
+               {sign} * count(*),
+               {sign} * count(resolution_date - report_date),
+               {sign} * coalesce(sum(round(extract(epoch FROM resolution_date - report_date)))::bigint, 0)
+        FROM {source}
+        GROUP BY 1, 2, 3, 4
+        ON CONFLICT (day, system_id, status, priority) DO UPDATE
+        SET bug_count = s.bug_count + EXCLUDED.bug_count,
+            resolved_count = s.resolved_count + EXCLUDED.resolved_count,
+            resolution_seconds = s.resolution_seconds + EXCLUDED.resolution_seconds
+    '''
+
+
+def _bug_stats_net_upsert(parts):
+    """Like _bug_stats_upsert for several (source, sign) parts at once, skipping groups whose net change is zero"""
+    union = '\n                UNION ALL\n'.join(f'''
+                SELECT coalesce(report_date::date, DATE '1970-01-01') AS day, coalesce(system_id, 0) AS system_id,
+                       coalesce(status, '') AS status, coalesce(priority, '') AS priority,
+                       {sign} AS bugs, {sign} * (resolution_date - report_date IS NOT NULL)::int AS resolved,
+                       {sign} * coalesce(round(extract(epoch FROM resolution_date - report_date))::bigint, 0) AS seconds
+                FROM {source}''' for source, sign in parts)
+    return f'''
+        INSERT INTO bug_daily_stats AS s (day, system_id, status, priority, bug_count, resolved_count, resolution_seconds)
+        SELECT day, system_id, status, priority, sum(bugs), sum(resolved), sum(seconds)
+        FROM ({union}
+        ) AS delta
+        GROUP BY 1, 2, 3, 4
+        HAVING sum(bugs) <> 0 OR sum(resolved) <> 0 OR sum(seconds) <> 0
+        ON CONFLICT (day, system_id, status, priority) DO UPDATE
+        SET bug_count = s.bug_count + EXCLUDED.bug_count,
+            resolved_count = s.resolved_count + EXCLUDED.resolved_count,
+            resolution_seconds = s.resolution_seconds + EXCLUDED.resolution_seconds
+    '''
+
+
+MIGRATIONS = [
+    Migration(1, 'create users and bugs tables', [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            username TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            is_admin BOOLEAN DEFAULT FALSE,
+            active BOOLEAN DEFAULT TRUE,
+            m18 BOOLEAN DEFAULT FALSE,
+            eshop BOOLEAN DEFAULT FALSE,
+            jetplus BOOLEAN DEFAULT FALSE,
+            sugarcrm BOOLEAN DEFAULT FALSE,
+            shopline BOOLEAN DEFAULT FALSE
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS bugs (
+            id SERIAL PRIMARY KEY,
+            report_date TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+            system TEXT NOT NULL,
+            bug_details TEXT NOT NULL,
+            reported_by TEXT NOT NULL,
+            status TEXT DEFAULT '開放中',
+            priority TEXT DEFAULT '中',
+            severity TEXT DEFAULT '中',
+            assigned_to TEXT,
+            resolution_date TIMESTAMPTZ,
+            notes TEXT,
+            reported_by_user_id INTEGER REFERENCES users(id),
+            file_path TEXT
+        )
+        ''',
+    ]),
+
+    # Version counters used to invalidate in-process caches across workers
+    Migration(2, 'create cache_versions table', [
+        '''
+        CREATE TABLE IF NOT EXISTS cache_versions (
+            name TEXT PRIMARY KEY,
+            version BIGINT NOT NULL DEFAULT 0
+        )
+        ''',
+    ]),
+
+    # Normalized system / permission model: one row per system, a
+    # user -> system mapping, and bugs.system_id for indexable filters.
+    # The backfills translate the legacy free-text column / boolean flags.
+    Migration(3, 'normalize systems and user permissions', [
+        '''
+        CREATE TABLE IF NOT EXISTS systems (
+            id SERIAL PRIMARY KEY,
+            code TEXT UNIQUE NOT NULL,
+            name TEXT NOT NULL
+        )
+        ''',
+        (
+            'INSERT INTO systems (code, name) VALUES ' + ', '.join(['(%s, %s)'] * len(SYSTEMS)) +
+            ' ON CONFLICT (code) DO NOTHING',
+            [value for system in SYSTEMS for value in system]
+        ),
+        '''
+        CREATE TABLE IF NOT EXISTS user_systems (
+            user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+            system_id INTEGER NOT NULL REFERENCES systems(id) ON DELETE CASCADE,
+            PRIMARY KEY (user_id, system_id)
+        )
+        ''',
+        'ALTER TABLE bugs ADD COLUMN IF NOT EXISTS system_id INTEGER REFERENCES systems(id)',
+        '''
+        UPDATE bugs SET system_id = (
+            SELECT s.id FROM systems s WHERE bugs.system ILIKE '%' || s.code || '%' ORDER BY s.id LIMIT 1
+        )
+        WHERE system_id IS NULL
+        ''',
+        '''
+        INSERT INTO user_systems (user_id, system_id)
+        SELECT u.id, s.id
+        FROM users u JOIN systems s ON
+            (s.code = 'm18' AND u.m18) OR (s.code = 'eshop' AND u.eshop) OR
+            (s.code = 'jetplus' AND u.jetplus) OR (s.code = 'sugarcrm' AND u.sugarcrm) OR
+            (s.code = 'shopline' AND u.shopline)
+        ON CONFLICT DO NOTHING
+        ''',
+    ]),
+
+    # Full-text search: split CJK runs into overlapping bigrams so that
+    # Traditional Chinese text becomes searchable with the 'simple' config.
+    # The trigram index makes the substring (ILIKE '%q%') filter indexable;
+    # pg_trgm ships with Supabase and is skipped with a notice elsewhere.
+    Migration(4, 'add bug search columns', [
+        r'''
+        CREATE OR REPLACE FUNCTION bug_search_tokens(doc TEXT) RETURNS TEXT
+        LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+            SELECT coalesce(doc, '') || ' ' || coalesce(string_agg(substr(r.run, i, 2), ' ' ORDER BY m.ord, i), '')
+            FROM regexp_matches(coalesce(doc, ''), '[\u3400-\u9fff\uf900-\ufaff]+', 'g') WITH ORDINALITY AS m(match, ord)
+            CROSS JOIN LATERAL (SELECT m.match[1] AS run) r
+            CROSS JOIN LATERAL generate_series(1, greatest(length(r.run) - 1, 1)) AS i
+        $$
+        ''',
+        f'''
+        ALTER TABLE bugs ADD COLUMN IF NOT EXISTS search_text TEXT
+            GENERATED ALWAYS AS ({BUG_SEARCH_DOCUMENT}) STORED
+        ''',
+        f'''
+        ALTER TABLE bugs ADD COLUMN IF NOT EXISTS search_vector TSVECTOR
+            GENERATED ALWAYS AS (to_tsvector('simple', bug_search_tokens({BUG_SEARCH_DOCUMENT}))) STORED
+        ''',
+        'CREATE INDEX IF NOT EXISTS bugs_search_vector_idx ON bugs USING GIN (search_vector)',
+        '''
+        DO $$
+        BEGIN
+            CREATE EXTENSION IF NOT EXISTS pg_trgm;
+            CREATE INDEX IF NOT EXISTS bugs_search_text_trgm_idx ON bugs USING GIN (search_text gin_trgm_ops);
+        EXCEPTION WHEN OTHERS THEN
+            RAISE NOTICE 'pg_trgm not available, search will not use a trigram index: %', SQLERRM;
+        END
+        $$
+        ''',
+    ]),
+
+    # Indexes for the index() / export_excel() query shapes:
+    #   admin:      ORDER BY report_date DESC, id DESC
+    #   non-admin:  reported_by_user_id = ? OR system_id = ANY(?) ORDER BY report_date DESC, id DESC
+    # (a BitmapOr over the two composite indexes), plus status-filtered lists.
+    # The composite system_id index supersedes the single-column one.
+    Migration(5, 'add indexes for bug list and export queries', [
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS bugs_report_date_id_idx ON bugs (report_date DESC, id DESC)',
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS bugs_reporter_report_date_idx ON bugs (reported_by_user_id, report_date DESC, id DESC)',
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS bugs_system_report_date_idx ON bugs (system_id, report_date DESC, id DESC)',
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS bugs_status_report_date_idx ON bugs (status, report_date DESC)',
+        'DROP INDEX CONCURRENTLY IF EXISTS bugs_system_id_idx',
+    ], transactional=False),
+
+    # Incremental exports filter on report_date OR resolution_date (?since=)
+    Migration(6, 'add resolution_date index for incremental exports', [
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS bugs_resolution_date_idx ON bugs (resolution_date)',
+    ], transactional=False),
+    # bugs.file_path held a JSON array of public URLs (or a single legacy path);
+    # each entry becomes one attachments row keyed by its bucket path.
+    # UNIQUE (bug_id, storage_key) also serves as the bug_id lookup index.
+    Migration(7, 'move attachments from bugs.file_path into an attachments table', [
+        '''
+        CREATE TABLE IF NOT EXISTS attachments (
+            id SERIAL PRIMARY KEY,
+            bug_id INTEGER NOT NULL REFERENCES bugs(id) ON DELETE CASCADE,
+            storage_key TEXT NOT NULL,
+            size BIGINT,
+            content_type TEXT,
+            content_hash TEXT,
+            thumbnail_key TEXT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (bug_id, storage_key)
+        )
+        ''',
+        r'''
+        INSERT INTO attachments (bug_id, storage_key, content_type, content_hash, thumbnail_key, created_at)
+        SELECT bug_id,
+               storage_key,
+               CASE WHEN storage_key ~* '\.jpe?g$' THEN 'image/jpeg'
+                    WHEN storage_key ~* '\.png$' THEN 'image/png' END,
+               substring(storage_key from '([0-9a-f]{64})\.[A-Za-z]+$'),
+               CASE WHEN storage_key !~ '^https?://' THEN
+                   regexp_replace(regexp_replace(storage_key, '([^/]*)$', 'thumbs/\1'), '\.[^./]*$', '') || '.jpg'
+               END,
+               created_at
+        FROM (
+            SELECT b.id AS bug_id,
+                   regexp_replace(f.value, '^.*/storage/v1/object/public/[^/]+/', '') AS storage_key,
+                   COALESCE(b.report_date, CURRENT_TIMESTAMP) AS created_at,
+                   f.ord
+            FROM bugs b
+            CROSS JOIN LATERAL jsonb_array_elements_text(
+                CASE WHEN b.file_path ~ '^\s*\[' THEN b.file_path::jsonb
+                     ELSE jsonb_build_array(b.file_path) END
+            ) WITH ORDINALITY AS f(value, ord)
+            WHERE b.file_path IS NOT NULL AND btrim(b.file_path) <> ''
+        ) AS legacy
+        WHERE storage_key <> ''
+        ORDER BY bug_id, ord
+        ON CONFLICT (bug_id, storage_key) DO NOTHING
+        ''',
+        'ALTER TABLE bugs DROP COLUMN IF EXISTS file_path',
+    ]),
+    # Files accepted while Storage is unavailable wait here until the
+    # background worker uploads them; next_attempt_at NULL means it gave up.
+    Migration(8, 'add pending_uploads queue for deferred attachment uploads', [
+        '''
+        CREATE TABLE IF NOT EXISTS pending_uploads (
+            id SERIAL PRIMARY KEY,
+            bug_id INTEGER NOT NULL REFERENCES bugs(id) ON DELETE CASCADE,
+            filename TEXT NOT NULL,
+            content_type TEXT,
+            data BYTEA NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            next_attempt_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS pending_uploads_next_attempt_idx ON pending_uploads (next_attempt_at)',
+    ]),
+    # Dashboard rollup: one row per report day x system x status x priority.
+    # Statement-level triggers fold each write's transition table into it,
+    # so bulk imports cost one grouped upsert instead of one per row. The
+    # triggers are created before the backfill; CREATE TRIGGER locks bugs
+    # against writes until this migration commits, so nothing is missed.
+    Migration(9, 'add bug_daily_stats rollup maintained by triggers', [
+        '''
+        CREATE TABLE IF NOT EXISTS bug_daily_stats (
+            day DATE NOT NULL,
+            system_id INTEGER NOT NULL,          -- 0 = not mapped to a system
+            status TEXT NOT NULL,
+            priority TEXT NOT NULL,
+            bug_count INTEGER NOT NULL DEFAULT 0,
+            resolved_count INTEGER NOT NULL DEFAULT 0,
+            resolution_seconds BIGINT NOT NULL DEFAULT 0,   -- sum of resolution_date - report_date
+            PRIMARY KEY (day, system_id, status, priority)
+        )
+        ''',
+        f'''
+        CREATE OR REPLACE FUNCTION bug_daily_stats_apply() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                {_bug_stats_upsert('old_rows', -1)};
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                {_bug_stats_upsert('new_rows', 1)};
+            END IF;
+            RETURN NULL;
+        END
+        $$
+        ''',
+        'DROP TRIGGER IF EXISTS bug_daily_stats_insert ON bugs',
+        '''
+        CREATE TRIGGER bug_daily_stats_insert AFTER INSERT ON bugs
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION bug_daily_stats_apply()
+        ''',
+        'DROP TRIGGER IF EXISTS bug_daily_stats_update ON bugs',
+        '''
+        CREATE TRIGGER bug_daily_stats_update AFTER UPDATE ON bugs
+        REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION bug_daily_stats_apply()
+        ''',
+        'DROP TRIGGER IF EXISTS bug_daily_stats_delete ON bugs',
+        '''
+        CREATE TRIGGER bug_daily_stats_delete AFTER DELETE ON bugs
+        REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION bug_daily_stats_apply()
+        ''',
+        'DELETE FROM bug_daily_stats',
+        _bug_stats_upsert('bugs', 1),
+    ]),
+    # Row version for conditional GETs on /view/<id>: every UPDATE of a bug
+    # and every attachment change touches bugs.updated_at. Because attachment
+    # changes now update bugs, the rollup trigger is redefined to net out old
+    # and new rows first, so updates that change no counted column write
+    # nothing to bug_daily_stats.
+    Migration(10, 'add bugs.updated_at maintained by triggers', [
+        'ALTER TABLE bugs ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP',
+        '''
+        CREATE OR REPLACE FUNCTION bugs_touch_updated_at() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            NEW.updated_at := clock_timestamp();
+            RETURN NEW;
+        END
+        $$
+        ''',
+        'DROP TRIGGER IF EXISTS bugs_touch_updated_at ON bugs',
+        '''
+        CREATE TRIGGER bugs_touch_updated_at BEFORE UPDATE ON bugs
+        FOR EACH ROW EXECUTE FUNCTION bugs_touch_updated_at()
+        ''',
+        '''
+        CREATE OR REPLACE FUNCTION attachments_touch_bug() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                UPDATE bugs SET updated_at = clock_timestamp() WHERE id IN (SELECT bug_id FROM old_rows);
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                UPDATE bugs SET updated_at = clock_timestamp() WHERE id IN (SELECT bug_id FROM new_rows);
+            END IF;
+            RETURN NULL;
+        END
+        $$
+        ''',
+        'DROP TRIGGER IF EXISTS attachments_touch_bug_insert ON attachments',
+        '''
+        CREATE TRIGGER attachments_touch_bug_insert AFTER INSERT ON attachments
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION attachments_touch_bug()
+        ''',
+        'DROP TRIGGER IF EXISTS attachments_touch_bug_update ON attachments',
+        '''
+        CREATE TRIGGER attachments_touch_bug_update AFTER UPDATE ON attachments
+        REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION attachments_touch_bug()
+        ''',
+        'DROP TRIGGER IF EXISTS attachments_touch_bug_delete ON attachments',
+        '''
+        CREATE TRIGGER attachments_touch_bug_delete AFTER DELETE ON attachments
+        REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION attachments_touch_bug()
+        ''',
+        f'''
+        CREATE OR REPLACE FUNCTION bug_daily_stats_apply() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP = 'UPDATE' THEN
+                {_bug_stats_net_upsert([('old_rows', -1), ('new_rows', 1)])};
+            ELSIF TG_OP = 'DELETE' THEN
+                {_bug_stats_upsert('old_rows', -1)};
+            ELSE
+                {_bug_stats_upsert('new_rows', 1)};
+            END IF;
+            RETURN NULL;
+        END
+        $$
+        ''',
+    ]),
+    # The trigram index serves the ILIKE '%q%' recheck of longer searches
+    # (CJK bigrams go through bugs_search_vector_idx). Migration 4 skips it
+    # with only a notice when pg_trgm is missing; it is required now, so a
+    # database without the extension fails here instead of silently
+    # searching by sequential scan. Where migration 4 built it, this is a no-op.
+    Migration(11, 'require pg_trgm index on bugs.search_text', [
+        'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS bugs_search_text_trgm_idx ON bugs USING GIN (search_text gin_trgm_ops)',
+    ], transactional=False),
+
+    # Migration 7 guessed a thumbs/<name>.jpg key for every legacy file, but
+    # no thumbnail was ever generated for them. Its rows are the only ones
+    # without a size: the app records one for every upload that gets a
+    # thumbnail (server uploads only make one for a sized stream, direct
+    # uploads take it from Storage's Content-Length).
+    Migration(12, 'clear guessed thumbnail keys of migrated attachments', [
+        'UPDATE attachments SET thumbnail_key = NULL WHERE size IS NULL AND thumbnail_key IS NOT NULL',
+    ]),
+
+    # Keyset pagination compares (report_date, id) row values, which skip
+    # NULLs, and the cursor cannot encode one. New bugs always get a date;
+    # rows without one take their resolution date, else their last update.
+    # The rollup trigger moves them out of the 1970-01-01 bucket.
+    Migration(13, 'make bugs.report_date NOT NULL', [
+        'UPDATE bugs SET report_date = COALESCE(resolution_date, updated_at) WHERE report_date IS NULL',
+        'ALTER TABLE bugs ALTER COLUMN report_date SET NOT NULL',
+    ]),
+
+    # No query filters on status and sorts by report_date (the list and export
+    # keyset queries use the (report_date, id) and permission indexes), so the
+    # status index from migration 5 only added write cost.
+    Migration(14, 'drop unused bugs status index', [
+        'DROP INDEX CONCURRENTLY IF EXISTS bugs_status_report_date_idx',
+    ], transactional=False),
+]
+
+_CONCURRENT_INDEX = re.compile(r'CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+IF\s+NOT\s+EXISTS\s+(\w+)', re.IGNORECASE)
+
+
+def _check_order(migrations):
+    versions = [m.version for m in migrations]
+    if versions != sorted(set(versions)):
+        raise ValueError(f"Migration versions must be unique and ascending: {versions}")
+
+
+def _statement_sql(statement):
+    return statement if isinstance(statement, str) else statement[0]
+
+
+def _execute(cursor, statement):
+    if isinstance(statement, str):
+        cursor.execute(statement)
+    else:
+        cursor.execute(*statement)
+
+
+def _drop_invalid_index(cursor, statement):
+    """Drop a leftover INVALID index from an interrupted CREATE INDEX CONCURRENTLY.
+
+    IF NOT EXISTS would otherwise skip it and leave the index unusable.
+    """
+    match = _CONCURRENT_INDEX.search(_statement_sql(statement))
+    if not match:
+        return
+    cursor.execute('''
+        SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = %s AND NOT i.indisvalid
+    ''', (match.group(1),))
+    if cursor.fetchone():
+        print(f"  Dropping invalid index {match.group(1)} left by an interrupted build")
+        cursor.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {match.group(1)}')
+
+
+def get_applied_versions(cursor):
+    cursor.execute("SELECT to_regclass('schema_migrations') IS NOT NULL")
+    if not cursor.fetchone()[0]:
+        return set()
+    cursor.execute('SELECT version FROM schema_migrations')
+    return {row[0] for row in cursor.fetchall()}
+
+
+def run_migrations(dry_run=False, migrations=MIGRATIONS):
+    """Apply pending migrations in order; with dry_run only print them"""
+    _check_order(migrations)
+    conn = get_db_connection()
+    conn.autocommit = True
+    cursor = conn.cursor()
+    locked = False
+    try:
+        if not dry_run:
+            cursor.execute('SELECT pg_advisory_lock(%s)', (MIGRATION_LOCK_ID,))
+            locked = True
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+        applied = get_applied_versions(cursor)
+        pending = [m for m in migrations if m.version not in applied]
+        if not pending:
+            print("Database schema is up to date.")
+            return []
+
+        for migration in pending:
+            mode = '' if migration.transactional else ' (outside transaction)'
+            print(f"{'[dry-run] ' if dry_run else ''}Migration {migration.version:04d}: {migration.name}{mode}")
+            if dry_run:
+                for statement in migration.statements:
+                    print(textwrap.indent(textwrap.dedent(_statement_sql(statement)).strip(), '    ') + ';')
+                continue
+
+            if migration.transactional:
+                cursor.execute('BEGIN')
+                try:
+                    for statement in migration.statements:
+                        _execute(cursor, statement)
+                    cursor.execute('INSERT INTO schema_migrations (version, name) VALUES (%s, %s)',
+                                   (migration.version, migration.name))
+                    cursor.execute('COMMIT')
+                except Exception:
+                    cursor.execute('ROLLBACK')
+                    raise
+            else:
+                # Every statement must be idempotent (IF [NOT] EXISTS) so a
+                # failed run can simply be retried.
+                for statement in migration.statements:
+                    _drop_invalid_index(cursor, statement)
+                    _execute(cursor, statement)
+                cursor.execute('INSERT INTO schema_migrations (version, name) VALUES (%s, %s)',
+                               (migration.version, migration.name))
+
+            for notice in conn.notices:
+                print(f"  {notice.strip()}")
+            del conn.notices[:]
+
+        return pending
+    finally:
+        if locked:
+            try:
+                cursor.execute('SELECT pg_advisory_unlock(%s)', (MIGRATION_LOCK_ID,))
+            except psycopg2.Error as e:
+                print(f"Error releasing migration lock: {e}")
+        cursor.close()
+        conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Apply database schema migrations')
+    parser.add_argument('--dry-run', action='store_true', help='print pending migrations without applying them')
+    args = parser.parse_args()
+    run_migrations(dry_run=args.dry_run)
@@ -1,15 +1,24 @@
 # -*- coding: utf-8 -*-
 """
 Supabase Storage 上傳檔案範例（官方推薦寫法）
-支援 jpg / png，從本地檔案上傳
+支援 jpg / png，從本地檔案或上傳串流（不落地）上傳
 使用 .env 載入設定
 """
 
+import hashlib
+import io
 import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from supabase import create_client, Client
+from urllib.parse import urlsplit, parse_qs
 from dotenv import load_dotenv
 
+# httpx / Pillow / supabase SDK 都在第一次使用時才 import：
+# 匯入本模組不做任何網路連線或輸出，web worker 啟動時不需為用不到的 client 付出成本
+
 # =============================================
 # 載入 .env
 # =============================================
@@ -18,47 +27,259 @@ load_dotenv()
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 BUCKET_NAME  = os.getenv("BUCKET_NAME", "pgbug_doc")
+UPLOAD_MAX_WORKERS = int(os.getenv("UPLOAD_MAX_WORKERS", "4"))   # 批次上傳的並行數上限
+THUMBNAIL_MAX_SIZE = int(os.getenv("THUMBNAIL_MAX_SIZE", "480"))  # 縮圖最長邊（px）
+THUMBNAIL_QUALITY  = int(os.getenv("THUMBNAIL_QUALITY", "75"))
+THUMBNAIL_MAX_WORKERS = int(os.getenv("THUMBNAIL_MAX_WORKERS", "2"))    # 背景補縮圖的並行數上限
+THUMBNAIL_QUEUE_MAX   = int(os.getenv("THUMBNAIL_QUEUE_MAX", "100"))    # 執行中＋排隊的背景縮圖工作上限
+UPLOAD_RECOMPRESS_MAX_BYTES = int(os.getenv("UPLOAD_RECOMPRESS_MAX_BYTES", "0"))  # 原圖超過此大小時重新壓縮（0 = 不處理）
+UPLOAD_MAX_DIMENSION = int(os.getenv("UPLOAD_MAX_DIMENSION", "2560"))           # 重新壓縮時原圖最長邊上限（px）
+# 以內容雜湊命名的物件內容永不改變，可讓瀏覽器 / CDN 永久快取
+CONTENT_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Storage 呼叫的時間上限與重試 / 斷路設定（秒）
+STORAGE_CONNECT_TIMEOUT = float(os.getenv("STORAGE_CONNECT_TIMEOUT", "5"))
+STORAGE_READ_TIMEOUT    = float(os.getenv("STORAGE_READ_TIMEOUT", "30"))    # 兩次收到資料之間的最長等待
+STORAGE_WRITE_TIMEOUT   = float(os.getenv("STORAGE_WRITE_TIMEOUT", "30"))   # 兩次送出資料之間的最長等待
+STORAGE_POOL_TIMEOUT    = float(os.getenv("STORAGE_POOL_TIMEOUT", "5"))     # 等待可用連線
+STORAGE_RETRY_ATTEMPTS  = int(os.getenv("STORAGE_RETRY_ATTEMPTS", "3"))     # 可重試步驟的總嘗試次數
+STORAGE_RETRY_MAX_WAIT  = float(os.getenv("STORAGE_RETRY_MAX_WAIT", "2"))   # 單次退避上限
+STORAGE_BREAKER_THRESHOLD = int(os.getenv("STORAGE_BREAKER_THRESHOLD", "5"))  # 連續幾次暫時性失敗後斷路
+STORAGE_BREAKER_RESET     = float(os.getenv("STORAGE_BREAKER_RESET", "30"))   # 斷路多久後放行一次試探請求
+
+# =============================================
+# Client（第一次使用時建立，之後整個程序共用）
+# =============================================
+_client_lock = threading.Lock()
+_http_client = None
+_supabase_client = None
 
-# 基本檢查
-if not all([SUPABASE_URL, SUPABASE_KEY]):
-    print("錯誤：.env 缺少 SUPABASE_URL 或 SUPABASE_KEY")
-    print("請確認已使用 service_role key（而非 anon key）")
-    exit(1)
+def _require_config():
+    if not SUPABASE_URL or not SUPABASE_KEY:
+        raise RuntimeError("Supabase credentials not configured (SUPABASE_URL or SUPABASE_KEY missing)")
 
-print("設定載入完成：")
-print(f"  URL    : {SUPABASE_URL}")
-print(f"  Bucket : {BUCKET_NAME}")
-print("-" * 50)
+def get_http_client():
+    """
+    共用的 httpx.Client：保持 keep-alive 連線，h2 可用時以 HTTP/2 多工
+    （fork 後由 _forget_clients_after_fork 清掉，每個 worker 各自在第一次呼叫時建立，不會共用 socket）
+    """
+    global _http_client
+    if _http_client is None:
+        with _client_lock:
+            if _http_client is None:
+                import httpx
+                try:
+                    import h2  # noqa: F401  (httpx 的 HTTP/2 支援)
+                    http2 = True
+                except ImportError:
+                    http2 = False
+                _http_client = httpx.Client(
+                    http2=http2,
+                    timeout=httpx.Timeout(connect=STORAGE_CONNECT_TIMEOUT, read=STORAGE_READ_TIMEOUT,
+                                          write=STORAGE_WRITE_TIMEOUT, pool=STORAGE_POOL_TIMEOUT),
+                    limits=httpx.Limits(max_keepalive_connections=UPLOAD_MAX_WORKERS * 2, keepalive_expiry=30.0),
+                )
+    return _http_client
+
+def get_supabase_client():
+    """官方 supabase SDK client（本模組的上傳流程不需要；保留給需要其他 SDK 功能的腳本）"""
+    global _supabase_client
+    if _supabase_client is None:
+        _require_config()
+        with _client_lock:
+            if _supabase_client is None:
+                from supabase import create_client
+                _supabase_client = create_client(SUPABASE_URL, SUPABASE_KEY)
+    return _supabase_client
+
+def __getattr__(name):
+    # 相容舊腳本的 tt.supabase 寫法，存取時才建立 client
+    if name == "supabase":
+        return get_supabase_client()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def _forget_clients_after_fork():
+    # fork 出來的 worker 不可沿用父程序的 keep-alive socket：直接丟棄參照（不 close），第一次使用時重建
+    global _http_client, _supabase_client, _client_lock
+    _http_client = None
+    _supabase_client = None
+    _client_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_forget_clients_after_fork)
 
 # =============================================
-# 初始化 Supabase client
+# 斷路器與重試
 # =============================================
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-print("Supabase client 初始化完成")
+class StorageUnavailable(RuntimeError):
+    """Storage 斷路中時丟出：呼叫端應快速失敗（或把檔案排入佇列稍後上傳），不要再等待"""
+
+
+class CircuitBreaker:
+    """
+    連續 threshold 次暫時性失敗後「斷路」reset_timeout 秒，期間所有呼叫直接失敗；
+    時間到後放行一個試探請求（half-open），成功即恢復，失敗則重新計時
+    每次狀態改變都會換一個 generation：呼叫結果只計入它開始時的 generation，
+    斷路前就在進行、之後才完成的慢呼叫不會關閉斷路或重設試探請求
+    """
+    def __init__(self, threshold: int, reset_timeout: float):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+
+    def allow(self):
+        """Generation to pass to record_success / record_failure, or None if the call must fail fast"""
+        with self._lock:
+            if self._opened_at is None:
+                return self._generation
+            if time.monotonic() - self._opened_at >= self.reset_timeout and not self._trial_in_flight:
+                self._trial_in_flight = True
+                self._generation += 1
+                return self._generation
+            return None
+
+    def record_success(self, generation: int):
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._failures = 0
+            if self._opened_at is not None:
+                self._opened_at = None
+                self._trial_in_flight = False
+                self._generation += 1
+
+    def record_failure(self, generation: int):
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._failures += 1
+            if self._failures >= self.threshold or self._opened_at is not None:
+                self._opened_at = time.monotonic()
+                self._trial_in_flight = False
+                self._generation += 1
+
+    @property
+    def is_open(self) -> bool:
+        with self._lock:
+            return self._opened_at is not None and time.monotonic() - self._opened_at < self.reset_timeout
+
+
+_breaker = CircuitBreaker(STORAGE_BREAKER_THRESHOLD, STORAGE_BREAKER_RESET)
+
+def storage_available() -> bool:
+    """斷路器是否允許呼叫 Storage（False 表示近期連續失敗，應直接走佇列 / 錯誤路徑）"""
+    return not _breaker.is_open
+
+def _is_transient(exc) -> bool:
+    """逾時、連線錯誤、5xx 與 429 視為暫時性錯誤（可重試、計入斷路器）；其他 4xx 不是"""
+    import httpx
+    if isinstance(exc, httpx.TransportError):
+        return True
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code >= 500 or exc.response.status_code == 429
+    return False
+
+def _storage_call(fn, idempotent: bool = True):
+    """
+    經由斷路器執行一次 Storage 呼叫 fn()
+    idempotent 的步驟遇到暫時性錯誤時以帶 jitter 的指數退避重試（tenacity）
+    """
+    generation = _breaker.allow()
+    if generation is None:
+        raise StorageUnavailable("Storage 暫時無法使用（連續失敗，斷路中），請稍後再試")
+
+    from tenacity import Retrying, stop_after_attempt, wait_random_exponential, retry_if_exception
+    retrying = Retrying(
+        stop=stop_after_attempt(STORAGE_RETRY_ATTEMPTS if idempotent else 1),
+        wait=wait_random_exponential(multiplier=0.2, max=STORAGE_RETRY_MAX_WAIT),
+        retry=retry_if_exception(_is_transient),
+        reraise=True,
+    )
+    try:
+        result = retrying(fn)
+    except Exception as e:
+        # Storage 有回應的 4xx 代表服務本身正常，不計入斷路
+        if _is_transient(e):
+            _breaker.record_failure(generation)
+        else:
+            _breaker.record_success(generation)
+        raise
+    _breaker.record_success(generation)
+    return result
 
 # =============================================
-# 上傳函式（官方推薦寫法）
+# 串流上傳（直接呼叫 Storage REST API）
 # =============================================
-def upload_file_to_supabase(
-    local_path: str,
-    bucket_folder: str = "bug_screenshots",
-    upsert: bool = False,           # 是否允許覆蓋同名檔案
-    cache_control: str = "3600",    # 快取秒數（可選）
-    bug_id: int = None              # 錯誤記錄 ID（選填，用於檔案命名）
-) -> tuple:
+# storage3 的 upload() 只接受檔案路徑 / bytes / BufferedReader，
+# 無法直接吃 Werkzeug 的上傳串流；這裡自行以 httpx 逐塊送出 request body，
+# 檔案內容不會整份讀進記憶體，也不需要先寫到暫存檔
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+def _storage_headers(**extra):
+    headers = {"Authorization": f"Bearer {SUPABASE_KEY}", "apikey": SUPABASE_KEY}
+    headers.update(extra)
+    return headers
+
+def _storage_url(endpoint, storage_filename):
+    _require_config()
+    return f"{SUPABASE_URL.rstrip('/')}/storage/v1/{endpoint}/{BUCKET_NAME}/{storage_filename}"
+
+def _stream_size(stream):
+    """回傳可 seek 串流從目前位置到結尾的位元組數；無法 seek 時回傳 None"""
+    try:
+        position = stream.tell()
+        end = stream.seek(0, os.SEEK_END)
+        stream.seek(position)
+        return end - position
+    except (AttributeError, OSError, ValueError):
+        return None
+
+def _iter_chunks(stream, chunk_size=UPLOAD_CHUNK_SIZE):
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+def _post_stream_to_storage(storage_filename, stream, content_type, cache_control, upsert):
     """
-    上傳本地檔案到 Supabase Storage
-    回傳：(成功與否, 公開網址 或 錯誤訊息)
+    將串流 POST 到 /storage/v1/object/<bucket>/<path>，失敗時丟出 httpx.HTTPStatusError
+    upsert 且串流可 seek 時上傳可安全重送，才會重試（每次重試前倒回起點）
     """
-    if not os.path.exists(local_path):
-        return False, f"本地檔案不存在：{local_path}"
+    headers = _storage_headers(**{
+        "Content-Type": content_type,
+        "Cache-Control": f"max-age={cache_control}" if str(cache_control).isdigit() else cache_control,
+        "x-upsert": str(upsert).lower(),            # "true" 或 "false"
+    })
+    size = _stream_size(stream)
+    if size is not None:
+        headers["Content-Length"] = str(size)      # 已知長度時避免 chunked 傳輸
+
+    start = stream.tell() if stream.seekable() else None
+
+    def post():
+        if start is not None:
+            stream.seek(start)
+        response = get_http_client().post(_storage_url("object", storage_filename),
+                                          content=_iter_chunks(stream), headers=headers)
+        response.raise_for_status()
+        return response.json()
+
+    return _storage_call(post, idempotent=upsert and start is not None)
 
-    filename = os.path.basename(local_path)
-    name, ext = os.path.splitext(filename)
+def build_storage_filename(filename: str, bucket_folder: str = "bug_screenshots", bug_id: int = None) -> tuple:
+    """
+    依原始檔名產生 bucket 內路徑（{folder}/bug_<id>_<timestamp>_<name>.<ext>）
+    回傳：(storage_filename, content_type)；不支援的格式回傳 (None, 錯誤訊息)
+    """
+    name, ext = os.path.splitext(os.path.basename(filename))
     ext = ext.lower().lstrip(".")
 
     if ext not in ["jpg", "jpeg", "png"]:
-        return False, "只支援 jpg / jpeg / png 格式"
+        return None, "只支援 jpg / jpeg / png 格式"
 
     # 產生唯一檔名（避免衝突）
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -69,10 +290,207 @@ def upload_file_to_supabase(
 
     # 決定 content-type
     content_type = "image/jpeg" if ext in ["jpg", "jpeg"] else "image/png"
+    return storage_filename, content_type
+
+def content_storage_filename(digest: str, content_type: str, bucket_folder: str = "bug_screenshots") -> str:
+    """以內容 sha256 命名的 bucket 內路徑：{folder}/{sha256}.{jpg|png}，相同內容只存一份"""
+    ext = "jpg" if content_type == "image/jpeg" else "png"
+    return f"{bucket_folder}/{digest}.{ext}"
+
+def hash_stream(stream) -> tuple:
+    """
+    逐塊計算串流的 sha256，回傳 (hexdigest, 可重新讀取的串流)
+    可 seek 的串流算完後倒回原位置；不可 seek 的串流邊讀邊寫入暫存（回傳的暫存檔由呼叫端關閉）
+    """
+    digest = hashlib.sha256()
+    if stream.seekable():
+        start = stream.tell()
+        for chunk in _iter_chunks(stream):
+            digest.update(chunk)
+        stream.seek(start)
+        return digest.hexdigest(), stream
+
+    spool = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+    for chunk in _iter_chunks(stream):
+        digest.update(chunk)
+        spool.write(chunk)
+    spool.seek(0)
+    return digest.hexdigest(), spool
+
+def get_public_url(storage_filename: str) -> str:
+    """回傳 public bucket 內物件的公開網址（與 SDK get_public_url 相同格式，純字串組合不發出請求）"""
+    _require_config()
+    return f"{SUPABASE_URL.rstrip('/')}/storage/v1/object/public/{BUCKET_NAME}/{storage_filename}"
+
+# =============================================
+# 縮圖與重新壓縮
+# =============================================
+def thumbnail_key(storage_filename: str) -> str:
+    """原圖路徑（或公開網址）→ 縮圖路徑：{folder}/thumbs/{name}.jpg"""
+    folder, _, basename = storage_filename.rpartition("/")
+    stem = os.path.splitext(basename)[0]
+    return f"{folder}/thumbs/{stem}.jpg" if folder else f"thumbs/{stem}.jpg"
+
+def _to_rgb(image):
+    """JPEG 不支援透明，透明區域以白底合成"""
+    from PIL import Image
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        return background
+    return image.convert("RGB")
+
+def make_thumbnail(stream, max_size: int = THUMBNAIL_MAX_SIZE) -> io.BytesIO:
+    """從圖片串流產生 JPEG 縮圖（最長邊 max_size）"""
+    from PIL import Image, ImageOps
+    with Image.open(stream) as image:
+        image.draft("RGB", (max_size, max_size))   # JPEG 直接以較低解析度解碼，省記憶體與時間
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_size, max_size))
+        output = io.BytesIO()
+        _to_rgb(image).save(output, "JPEG", quality=THUMBNAIL_QUALITY, optimize=True, progressive=True)
+    output.seek(0)
+    return output
+
+def recompress_image(stream, content_type: str, max_dimension: int = UPLOAD_MAX_DIMENSION):
+    """
+    縮小並重新編碼過大的原圖（格式不變，JPEG 品質 85 / PNG optimize）
+    回傳：新的 BytesIO；結果沒有比原檔小時回傳 None，stream 位置維持不變
+    """
+    from PIL import Image, ImageOps
+    position = stream.tell()
+    original_size = _stream_size(stream)
+    with Image.open(stream) as image:
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_dimension, max_dimension))
+        output = io.BytesIO()
+        if content_type == "image/jpeg":
+            _to_rgb(image).save(output, "JPEG", quality=85, optimize=True, progressive=True)
+        else:
+            image.save(output, "PNG", optimize=True)
+    stream.seek(position)
+
+    if original_size is not None and output.tell() >= original_size:
+        return None
+    output.seek(0)
+    return output
+
+def _upload_thumbnail(storage_filename, stream, cache_control="3600") -> bool:
+    """產生縮圖並上傳到 thumbnail_key(storage_filename)；失敗只記錄，不影響原圖上傳結果"""
+    try:
+        thumbnail = make_thumbnail(stream)
+        _post_stream_to_storage(thumbnail_key(storage_filename), thumbnail, "image/jpeg", cache_control, upsert=True)
+        print(f"縮圖已上傳：{thumbnail_key(storage_filename)}")
+        return True
+    except Exception as e:
+        print(f"縮圖產生失敗（{storage_filename}）：{e}")
+        return False
+
+def create_thumbnail_from_storage(storage_filename: str, cache_control: str = "3600") -> bool:
+    """下載已在 Storage 的原圖（例如瀏覽器直傳的檔案）並補上縮圖"""
+    try:
+        with tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024) as buffer:
+            def download():
+                buffer.seek(0)
+                buffer.truncate()
+                with get_http_client().stream("GET", _storage_url("object", storage_filename),
+                                              headers=_storage_headers()) as response:
+                    response.raise_for_status()
+                    for chunk in response.iter_bytes(UPLOAD_CHUNK_SIZE):
+                        buffer.write(chunk)
+
+            _storage_call(download)
+            buffer.seek(0)
+            return _upload_thumbnail(storage_filename, buffer, cache_control)
+    except Exception as e:
+        print(f"下載原圖以產生縮圖失敗（{storage_filename}）：{e}")
+        return False
+
+# =============================================
+# 簽章直傳（瀏覽器直接 PUT 到 Storage，不經過 Flask）
+# =============================================
+def create_signed_upload_url(storage_filename: str, upsert: bool = False) -> tuple:
+    """
+    向 Storage 申請單一物件的簽章上傳網址（Supabase 固定 2 小時有效）
+    回傳：(成功與否, {"signed_url", "token"} 或 錯誤訊息)
+    """
+    def sign():
+        response = get_http_client().post(_storage_url("object/upload/sign", storage_filename),
+                                          headers=_storage_headers(**{"x-upsert": str(upsert).lower()}))
+        response.raise_for_status()
+        return response.json()
+
+    try:
+        url = _storage_call(sign)["url"]               # 形如 /object/upload/sign/<bucket>/<path>?token=...
+        token = (parse_qs(urlsplit(url).query).get("token") or [None])[0]
+        if not token:
+            return False, f"簽章回應缺少 token：{url}"
+        return True, {
+            "signed_url": f"{SUPABASE_URL.rstrip('/')}/storage/v1/{url.lstrip('/')}",
+            "token": token,
+        }
+    except Exception as e:
+        print(f"申請簽章上傳網址失敗：{e}")
+        return False, f"申請簽章上傳網址失敗: {e}"
+
+def storage_object_info(storage_filename: str):
+    """
+    以 HEAD 查詢 bucket 內物件；不存在時回傳 None，否則回傳 {"size", "content_type"}
+    Storage 回應其他錯誤時丟出 httpx.HTTPStatusError，斷路中丟出 StorageUnavailable
+    """
+    def head():
+        response = get_http_client().head(_storage_url("object", storage_filename), headers=_storage_headers())
+        if response.status_code not in (400, 404):
+            response.raise_for_status()
+        return response
+
+    response = _storage_call(head)
+    if response.status_code in (400, 404):
+        return None
+    size = response.headers.get("content-length")
+    return {"size": int(size) if size and size.isdigit() else None,
+            "content_type": response.headers.get("content-type")}
+
+def storage_object_exists(storage_filename: str) -> bool:
+    """以 HEAD 確認物件是否已存在於 bucket"""
+    return storage_object_info(storage_filename) is not None
+
+# =============================================
+# 上傳函式
+# =============================================
+def upload_file_to_supabase(
+    local_path: str = None,
+    bucket_folder: str = "bug_screenshots",
+    upsert: bool = False,           # 是否允許覆蓋同名檔案（內容雜湊命名時不適用）
+    cache_control: str = "3600",    # 快取秒數（可選；內容雜湊命名時固定使用 CONTENT_CACHE_CONTROL）
+    bug_id: int = None,             # 錯誤記錄 ID（選填，用於檔案命名）
+    stream=None,                    # 已開啟的 binary 串流（例如 FileStorage.stream），取代 local_path
+    filename: str = None,           # 搭配 stream 使用的原始檔名（決定副檔名與命名）
+    thumbnail: bool = True,         # 是否同時產生並上傳縮圖（見 thumbnail_key）
+    content_addressed: bool = True, # 以內容 sha256 命名並略過已存在的相同內容
+    details: bool = False           # 成功時改回傳附件資訊 dict（見下方）
+) -> tuple:
+    """
+    上傳本地檔案或 binary 串流到 Supabase Storage（串流需可 seek 才能產生縮圖）
+    回傳：(成功與否, 公開網址 或 錯誤訊息)
+    details=True 時成功回傳 (True, {"url", "storage_key", "size", "content_type", "content_hash", "thumbnail_key"})
+    Storage 暫時無法使用（斷路中、逾時 / 連線錯誤、5xx / 429）時丟出 StorageUnavailable，
+    呼叫端可稍後重試；其他失敗（4xx、檔案類型不符等）重試也不會成功，回傳 (False, 錯誤訊息)
+    """
+    if stream is None:
+        if not local_path or not os.path.exists(local_path):
+            return False, f"本地檔案不存在：{local_path}"
+        filename = os.path.basename(local_path)
+    elif not filename:
+        return False, "以串流上傳時必須提供 filename"
+
+    storage_filename, content_type = build_storage_filename(filename, bucket_folder, bug_id)
+    if storage_filename is None:
+        return False, content_type
 
     print(f"開始上傳：")
-    print(f"  本地     : {local_path}")
-    print(f"  目標路徑 : {storage_filename}")
+    print(f"  來源     : {local_path or f'<stream> {filename}'}")
     print(f"  MIME     : {content_type}")
 
     try:
@@ -81,40 +499,79 @@ def upload_file_to_supabase(
             error_msg = "Supabase credentials not configured (SUPABASE_URL or SUPABASE_KEY missing)"
             print(f"配置錯誤：{error_msg}")
             return False, error_msg
-        
-        with open(local_path, "rb") as file:
-            print(f"開始 POST 到 Supabase Storage...")
-            response = supabase.storage \
-                .from_(BUCKET_NAME) \
-                .upload(
-                    path=storage_filename,                  # bucket 內路徑 + 檔名
-                    file=file,                              # 已開啟的 binary file
-                    file_options={
-                        "content-type": content_type,
-                        "cache-control": cache_control,
-                        "upsert": str(upsert).lower()       # "true" 或 "false"
-                    }
-                )
-            print(f"上傳響應：{response}")
+
+        source = open(local_path, "rb") if stream is None else stream
+        opened = [source] if stream is None else []   # 結束時需要關閉的檔案 / 暫存
+        try:
+            body = source
+            # 原圖超過上限時先縮小重新壓縮（只有這種情況才會在記憶體中產生新檔）
+            if UPLOAD_RECOMPRESS_MAX_BYTES and (_stream_size(source) or 0) > UPLOAD_RECOMPRESS_MAX_BYTES:
+                body = recompress_image(source, content_type) or source
+                if body is not source:
+                    print(f"  重新壓縮 : {_stream_size(body)} bytes")
+
+            exists = False
+            digest = None
+            if content_addressed:
+                digest, hashed = hash_stream(body)
+                if hashed is not body:
+                    opened.append(hashed)
+                    body = hashed
+                storage_filename = content_storage_filename(digest, content_type, bucket_folder)
+                cache_control = CONTENT_CACHE_CONTROL
+                # 相同內容已存在：不重傳；並發上傳同內容時以 upsert 覆蓋相同位元組，不會衝突
+                exists = storage_object_exists(storage_filename)
+                upsert = True
+            print(f"  目標路徑 : {storage_filename}")
+
+            start = body.tell() if body.seekable() else None
+            size = _stream_size(body) if start is not None else None
+            if exists:
+                print(f"相同內容已存在，略過上傳")
+            else:
+                print(f"開始 POST 到 Supabase Storage...")
+                response = _post_stream_to_storage(storage_filename, body, content_type, cache_control, upsert)
+                print(f"上傳響應：{response}")
+
+            # 原圖上傳成功後倒回串流開頭產生縮圖（不可 seek 的串流略過；已存在的內容只補缺少的縮圖）
+            has_thumbnail = False
+            if thumbnail and start is not None:
+                has_thumbnail = exists and storage_object_exists(thumbnail_key(storage_filename))
+                if not has_thumbnail:
+                    body.seek(start)
+                    has_thumbnail = _upload_thumbnail(storage_filename, body, cache_control)
+        finally:
+            for f in opened:
+                f.close()
 
         # 如果 bucket 是 public，可直接取公開 URL
         print(f"獲取公開 URL...")
-        public_url_data = supabase.storage \
-            .from_(BUCKET_NAME) \
-            .get_public_url(storage_filename)
-
-        public_url = public_url_data.get("publicUrl") if isinstance(public_url_data, dict) else public_url_data
+        public_url = get_public_url(storage_filename)
 
         if not public_url:
-            error_msg = f"無法獲取公開 URL，response: {public_url_data}"
+            error_msg = f"無法獲取公開 URL：{storage_filename}"
             print(f"URL 錯誤：{error_msg}")
             return False, error_msg
 
         print("上傳成功！")
         print(f"公開網址：{public_url}")
+        if details:
+            return True, {
+                "url": public_url,
+                "storage_key": storage_filename,
+                "size": size,
+                "content_type": content_type,
+                "content_hash": digest,
+                "thumbnail_key": thumbnail_key(storage_filename) if has_thumbnail else None,
+            }
         return True, public_url
 
+    except StorageUnavailable:
+        raise
     except Exception as e:
+        if _is_transient(e):
+            print(f"Storage 暫時無法使用：{e}")
+            raise StorageUnavailable(f"Storage 暫時無法使用：{e}") from e
         error_str = str(e)
         print("上傳失敗：")
         print(error_str)
@@ -130,10 +587,78 @@ def upload_file_to_supabase(
         return False, f"上傳異常: {error_str}"
 
 
+# =============================================
+# 批次上傳（執行緒池並行，結果依提交順序回傳）
+# =============================================
+# 全程序共用的執行緒池，限制同時對 Storage 發出的上傳數量
+_upload_executor = ThreadPoolExecutor(max_workers=UPLOAD_MAX_WORKERS, thread_name_prefix="upload")
+
+# 背景縮圖另用獨立的執行緒池：大量圖片的 Pillow 工作不會排在 request 內的上傳之前。
+# 待處理工作數以號誌限制，滿了就略過（頁面以 onerror 退回原圖）
+_thumbnail_executor = ThreadPoolExecutor(max_workers=THUMBNAIL_MAX_WORKERS, thread_name_prefix="thumbnail")
+_thumbnail_slots = threading.BoundedSemaphore(THUMBNAIL_QUEUE_MAX)
+
+def _create_thumbnail_job(storage_filename: str, cache_control: str) -> bool:
+    try:
+        return create_thumbnail_from_storage(storage_filename, cache_control)
+    finally:
+        _thumbnail_slots.release()
+
+def schedule_thumbnail(storage_filename: str, cache_control: str = CONTENT_CACHE_CONTROL):
+    """在背景替已在 Storage 的原圖補上縮圖（直傳完成時使用，不阻塞 request）；佇列已滿時回傳 None"""
+    if not _thumbnail_slots.acquire(blocking=False):
+        print(f"縮圖佇列已滿，略過 {storage_filename}")
+        return None
+    try:
+        return _thumbnail_executor.submit(_create_thumbnail_job, storage_filename, cache_control)
+    except Exception:
+        _thumbnail_slots.release()
+        raise
+
+def _upload_item(item, **kwargs):
+    """item 可為本地路徑字串，或 (stream, filename) tuple；暫時性失敗回傳 (False, StorageUnavailable)"""
+    try:
+        if isinstance(item, tuple):
+            stream, filename = item
+            return upload_file_to_supabase(stream=stream, filename=filename, **kwargs)
+        return upload_file_to_supabase(local_path=item, **kwargs)
+    except StorageUnavailable as e:
+        return False, e
+
+def upload_files_to_supabase(items: list, **kwargs) -> list:
+    """
+    並行上傳多個檔案到 Supabase Storage（參數同 upload_file_to_supabase）
+    items 每一項為本地路徑，或 (binary 串流, 檔名)
+    回傳：與 items 相同順序的 [(成功與否, 公開網址 或 錯誤訊息), ...]
+    暫時性失敗的錯誤是 StorageUnavailable 例外物件（可排入佇列稍後重試），其他失敗為錯誤訊息字串
+    """
+    if len(items) <= 1:
+        return [_upload_item(item, **kwargs) for item in items]
+
+    futures = [_upload_executor.submit(_upload_item, item, **kwargs) for item in items]
+    results = []
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as e:
+            results.append((False, f"上傳異常: {e}"))
+    return results
+
+
 # =============================================
 # 執行測試
 # =============================================
 if __name__ == "__main__":
+    if not all([SUPABASE_URL, SUPABASE_KEY]):
+        print("錯誤：.env 缺少 SUPABASE_URL 或 SUPABASE_KEY")
+        print("請確認已使用 service_role key（而非 anon key）")
+        raise SystemExit(1)
+
+    print("設定載入完成：")
+    print(f"  URL    : {SUPABASE_URL}")
+    print(f"  Bucket : {BUCKET_NAME}")
+    print("-" * 50)
+
     # 請改成你真實的測試圖片路徑
     test_file = r"C:\ai_project2\eshop_bug_list\bak\test_bug.png"
 
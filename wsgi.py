@@ -0,0 +1,11 @@
+"""
+Production WSGI entry point.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+`python app.py` / `flask run` remain for local development only.
+"""
+
+from app import app
+
+application = app